@@ -0,0 +1,90 @@
+
+# CPU throughput of BertEncoder and ImageEncoder in float32 and under bfloat16
+# autocast, for inference and for a forward/backward training step.
+#
+#   python -m benchmarks.bench_autocast                      # tiny random BERT
+#   python -m benchmarks.bench_autocast --bert-type bert-base-uncased --resnet-type resnet50
+
+import argparse
+import os
+import tempfile
+import time
+
+import torch
+import torchvision
+
+import train_functions as tf
+from benchmarks.common import make_args, make_tiny_bert
+
+
+def throughput(fn, n_samples, steps):
+    fn()
+    start = time.perf_counter()
+    for _ in range(steps):
+        fn()
+    return n_samples * steps / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bert-type', default=None)
+    parser.add_argument('--resnet-type', default='resnet18')
+    parser.add_argument('--batch-sz', type=int, default=8)
+    parser.add_argument('--seq-len', type=int, default=256)
+    parser.add_argument('--steps', type=int, default=5)
+    parser.add_argument('--threads', type=int, default=None)
+    opts = parser.parse_args()
+
+    from transformers import BertModel
+
+    if opts.threads:
+        torch.set_num_threads(opts.threads)
+    torch.manual_seed(0)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        bert_type = opts.bert_type or make_tiny_bert(os.path.join(workdir, 'bert'), hidden_sz=256, n_layers=4)
+        args = make_args(bert_type=bert_type, resnet_type=opts.resnet_type, device=torch.device('cpu'))
+        bert_model = BertModel.from_pretrained(bert_type)
+        resnet_model = getattr(torchvision.models, opts.resnet_type)()
+
+    txtenc = tf.BertEncoder(args, bert_model)
+    imgenc = tf.ImageEncoder(args, resnet_model)
+
+    bsz = opts.batch_sz
+    txt = torch.randint(5, bert_model.config.vocab_size, (bsz, opts.seq_len))
+    mask = torch.ones_like(txt)
+    segment = torch.zeros_like(txt)
+    img = torch.randn(bsz, 3, 224, 224)
+
+    encoders = [
+        ('text', txtenc, lambda: txtenc(txt, mask, segment)),
+        ('image', imgenc, lambda: imgenc(img)),
+    ]
+
+    print('{:<8}{:<8}{:>14}{:>14}{:>10}'.format('encoder', 'mode', 'fp32 samp/s', 'bf16 samp/s', 'speedup'))
+    for name, encoder, forward in encoders:
+        for mode in ('infer', 'train'):
+            rates = []
+            for amp in (False, True):
+                args.amp = amp
+                if mode == 'infer':
+                    encoder.eval()
+
+                    def step():
+                        with torch.no_grad(), tf.autocast(args):
+                            forward()
+                else:
+                    encoder.train()
+
+                    def step():
+                        with tf.autocast(args):
+                            out = forward()
+                        out.float().sum().backward()
+                        encoder.zero_grad(set_to_none=True)
+
+                rates.append(throughput(step, bsz, opts.steps))
+            print('{:<8}{:<8}{:>14.1f}{:>14.1f}{:>9.2f}x'.format(name, mode, rates[0], rates[1], rates[1] / rates[0]))
+
+
+if __name__ == '__main__':
+    main()
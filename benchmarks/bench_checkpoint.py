@@ -0,0 +1,57 @@
+
+# Time the training loop is blocked per checkpoint: synchronous save_checkpoint
+# against AsyncCheckpointer.save (CPU snapshot, write on a background thread).
+#
+#   python -m benchmarks.bench_checkpoint --resnet-type resnet152 --n-saves 3
+
+import argparse
+import os
+import tempfile
+import time
+
+import torch
+import torch.optim as optim
+import torchvision
+
+import train_functions as tf
+
+
+def make_state(model, optimizer):
+    return {'epoch': 1, 'state_dict': model.state_dict(), 'optimizer': optimizer.state_dict(), 'model_type': 'image'}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--resnet-type', default='resnet152')
+    parser.add_argument('--n-saves', type=int, default=3)
+    opts = parser.parse_args()
+
+    model = getattr(torchvision.models, opts.resnet_type)()
+    optimizer = optim.AdamW(model.parameters(), lr=1e-5)
+    model(torch.randn(2, 3, 64, 64)).sum().backward()
+    optimizer.step()
+    n_params = sum(p.numel() for p in model.parameters())
+
+    with tempfile.TemporaryDirectory() as path:
+        for name, background in (('sync', False), ('async', True)):
+            checkpointer = tf.AsyncCheckpointer(background)
+            blocked = []
+            start = time.perf_counter()
+            for _ in range(opts.n_saves):
+                t = time.perf_counter()
+                checkpointer.save(make_state(model, optimizer), True, path)
+                blocked.append(time.perf_counter() - t)
+                # stands in for an epoch of training between two saves
+                time.sleep(2)
+            checkpointer.close()
+            total = time.perf_counter() - start - 2 * opts.n_saves
+            print('{:5s} {:.1f}M params: blocked {:.3f}s per save (first {:.3f}s), {:.3f}s wall beyond the epochs'.format(
+                name, n_params / 1e6, sum(blocked[1:]) / max(len(blocked) - 1, 1), blocked[0], total))
+
+        best = os.path.join(path, 'model_best.pt')
+        print('model_best.pt shares the checkpoint inode:', os.stat(best).st_ino == os.stat(os.path.join(path, 'checkpoint.pt')).st_ino)
+        model.load_state_dict(torch.load(best, weights_only=False)['state_dict'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+
+# Microbenchmark of collate_fn against the previous row-by-row implementation.
+#
+#   python -m benchmarks.bench_collate --batch-sizes 4 16 64 256
+
+import argparse
+import timeit
+
+import torch
+
+import train_functions as tf
+
+
+def legacy_collate_fn(batch, args):
+    lens = [len(row[0]) for row in batch]
+    bsz, max_seq_len = len(batch), max(lens)
+
+    mask_tensor = torch.zeros(bsz, max_seq_len).long()
+    text_tensor = torch.zeros(bsz, max_seq_len).long()
+    segment_tensor = torch.zeros(bsz, max_seq_len).long()
+
+    img_tensor = torch.stack([row[2] for row in batch])
+
+    tgt_tensor = torch.stack([row[3] for row in batch])
+
+    for i_batch, (input_row, length) in enumerate(zip(batch, lens)):
+        tokens, segment = input_row[:2]
+        text_tensor[i_batch, :length] = tokens
+        segment_tensor[i_batch, :length] = segment
+        mask_tensor[i_batch, :length] = 1
+
+    return text_tensor, segment_tensor, mask_tensor, img_tensor, tgt_tensor
+
+
+def make_batch(bsz, max_seq_len, n_classes, img_size, seed=0):
+    gen = torch.Generator().manual_seed(seed)
+    batch = []
+    for _ in range(bsz):
+        length = int(torch.randint(1, max_seq_len + 1, (1,), generator=gen))
+        tokens = torch.randint(5, 30000, (length,), generator=gen)
+        img = torch.randn(3, img_size, img_size, generator=gen)
+        tgt = (torch.rand(n_classes, generator=gen) > 0.8).float()
+        batch.append((tokens, torch.zeros(length), img, tgt))
+    return batch
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[4, 16, 64, 256])
+    parser.add_argument('--max-seq-len', type=int, default=512)
+    parser.add_argument('--img-size', type=int, default=224)
+    parser.add_argument('--n-classes', type=int, default=80)
+    parser.add_argument('--repeat', type=int, default=20)
+    opts = parser.parse_args()
+
+    buffers = tf.CollateBuffers(n_slots=2)
+    print('{:>6}{:>14}{:>14}{:>14}'.format('bsz', 'legacy ms', 'vector ms', 'buffers ms'))
+    for bsz in opts.batch_sizes:
+        batch = make_batch(bsz, opts.max_seq_len, opts.n_classes, opts.img_size)
+        reference = legacy_collate_fn(batch, None)
+        for out in (tf.collate_fn(batch, None), tf.collate_fn(batch, None, buffers)):
+            assert all(torch.equal(a, b) for a, b in zip(reference, out))
+
+        timings = []
+        for fn in (lambda: legacy_collate_fn(batch, None),
+                   lambda: tf.collate_fn(batch, None),
+                   lambda: tf.collate_fn(batch, None, buffers)):
+            timings.append(min(timeit.repeat(fn, number=1, repeat=opts.repeat)) * 1000)
+        print('{:>6}{:>14.3f}{:>14.3f}{:>14.3f}'.format(bsz, *timings))
+
+
+if __name__ == '__main__':
+    main()
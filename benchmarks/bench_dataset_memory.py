@@ -0,0 +1,106 @@
+
+# Memory of the DataLoader workers for the JsonlIndex-backed JsonlDataset
+# against the former list-of-dicts dataset, as the number of workers grows.
+# The private (copied-on-write) memory of the workers is read from
+# /proc/<pid>/smaps_rollup near the end of an epoch. Linux only.
+#
+#   python -m benchmarks.bench_dataset_memory --n-records 200000 --workers 0 2 4
+
+import argparse
+import functools
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+import train_functions as tf
+from benchmarks.common import make_args
+
+
+class LegacyJsonlDataset(Dataset):
+    # the former JsonlDataset: one dict per record, labels found by list.index
+    def __init__(self, data_path, args):
+        self.data = [json.loads(l) for l in open(data_path)]
+        self.args = args
+        self.n_classes = len(args.labels)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        label = torch.zeros(self.n_classes)
+        label[[self.args.labels.index(tgt) for tgt in self.data[index]['label']]] = 1
+        return None, None, None, label
+
+
+def write_records(path, n_records, n_labels=25, n_words=120, seed=0):
+    rng = np.random.RandomState(seed)
+    labels = ['label_{}'.format(i) for i in range(n_labels)]
+    words = ['w{}'.format(i) for i in range(5000)]
+    with open(path, 'w') as f:
+        for i in range(n_records):
+            row = {
+                'label': list(rng.choice(labels, rng.randint(1, 4), replace=False)),
+                'img': 'dataset/{}.jpeg'.format(i),
+                'text': ' '.join(rng.choice(words, n_words)),
+            }
+            f.write(json.dumps(row) + '\n')
+
+
+def private_mb(pid):
+    with open('/proc/{}/smaps_rollup'.format(pid)) as f:
+        fields = dict(line.split(':', 1) for line in f if ':' in line)
+    return sum(int(fields[k].split()[0]) for k in ('Private_Clean', 'Private_Dirty')) / 1024
+
+
+def worker_pids():
+    pid = os.getpid()
+    with open('/proc/{}/task/{}/children'.format(pid, pid)) as f:
+        return [int(p) for p in f.read().split()]
+
+
+def epoch_memory(dataset, args, n_workers):
+    loader = DataLoader(dataset, batch_size=256, shuffle=True, num_workers=n_workers,
+                        collate_fn=functools.partial(tf.collate_fn, args=args))
+    start = time.perf_counter()
+    stop = int(len(loader) * 0.9)
+    workers_mb = 0
+    for i, _ in enumerate(loader):
+        if i == stop:
+            workers_mb = sum(private_mb(pid) for pid in worker_pids())
+    return workers_mb, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n-records', type=int, default=200000)
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 2, 4])
+    opts = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as path:
+        data_path = os.path.join(path, 'train.jsonl')
+        write_records(data_path, opts.n_records)
+        index = tf.JsonlIndex(data_path)
+        args = make_args(labels=list(index.label_to_id))
+
+        for name in ('legacy', 'index'):
+            rss = private_mb(os.getpid())
+            start = time.perf_counter()
+            if name == 'legacy':
+                dataset = LegacyJsonlDataset(data_path, args)
+            else:
+                dataset = tf.JsonlDataset(data_path, None, None, None, args, modalities=())
+            build = time.perf_counter() - start
+            print('{:6s} build {:.2f}s, main process +{:.0f}MB'.format(name, build, private_mb(os.getpid()) - rss))
+            for n_workers in opts.workers:
+                workers_mb, elapsed = epoch_memory(dataset, args, n_workers)
+                print('{:6s} {} workers: {:.0f}MB private in workers, epoch {:.2f}s'.format(name, n_workers, workers_mb, elapsed))
+            del dataset
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+
+# get_datasets.download_images against a local HTTP stand-in for the COCO image
+# host. The server adds a fixed latency per request, fails every path once with
+# a 503 when --flaky is set, and returns 404 for a few missing images.
+#
+#   python -m benchmarks.bench_download --n-images 200 --latency 0.05
+
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def make_handler(latency, flaky, missing):
+    seen = set()
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(latency)
+            with lock:
+                first = self.path not in seen
+                seen.add(self.path)
+            if self.path in missing:
+                self.send_response(404)
+                self.end_headers()
+                return
+            if flaky and first:
+                self.send_response(503)
+                self.end_headers()
+                return
+            body = self.path.encode() * 512
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n-images', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 16])
+    parser.add_argument('--flaky', action='store_true')
+    opts = parser.parse_args()
+
+    import get_datasets as gd
+
+    missing = {'/img/{}.jpg'.format(i) for i in range(0, opts.n_images, 50)}
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(opts.latency, opts.flaky, missing))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+    try:
+        for n_workers in opts.workers:
+            with tempfile.TemporaryDirectory() as workdir:
+                jobs = [(base + '/img/{}.jpg'.format(i), os.path.join(workdir, '{}.jpg'.format(i)))
+                        for i in range(opts.n_images)]
+                manifest = os.path.join(workdir, 'failures.jsonl')
+
+                start = time.perf_counter()
+                failed = gd.download_images(jobs, n_workers=n_workers, backoff=0.01, manifest_path=manifest)
+                elapsed = time.perf_counter() - start
+                with open(manifest) as f:
+                    n_manifest = len([json.loads(line) for line in f])
+
+                start = time.perf_counter()
+                gd.download_images(jobs, n_workers=n_workers, backoff=0.01)
+                resumed = time.perf_counter() - start
+
+                print('workers={:<4} {:.2f}s  failed={} manifest={}  resume pass {:.2f}s'.format(
+                    n_workers, elapsed, len(failed), n_manifest, resumed))
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+
+# Peak memory and step time of a multimodel training step per fine-tuning
+# configuration: full fine-tuning, lower encoder layers frozen, encoders frozen,
+# each with and without activation checkpointing. Every configuration runs in
+# its own process so that the peak RSS (and the peak CUDA memory on GPU) is
+# its own. Untrained encoders are used, so no download is needed; pass a
+# local --bert-type to measure bert-base/large. Checkpointing must leave the
+# BatchNorm running stats as they are without it; the +ckpt runs are checked
+# against their counterparts.
+#
+#   python -m benchmarks.bench_finetune_memory --resnet-type resnet152 --batch-sz 16
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+CONFIGS = [
+    ('full', {}),
+    ('full+ckpt', {'activation_checkpointing': True}),
+    ('freeze_lower', {'freeze_bert_layers': 'half', 'freeze_resnet_layers': 2}),
+    ('freeze_lower+ckpt', {'freeze_bert_layers': 'half', 'freeze_resnet_layers': 2, 'activation_checkpointing': True}),
+    ('freeze_all', {'freeze_bert_layers': -1, 'freeze_resnet_layers': -1}),
+]
+
+
+def run_config(opts, config):
+    import torch
+    import torch.optim as optim
+    import torchvision
+    from transformers import BertConfig, BertModel
+
+    import train_functions as tf
+    from benchmarks.common import make_args
+
+    torch.manual_seed(0)
+    if opts.bert_type:
+        bert_model = BertModel.from_pretrained(opts.bert_type)
+    else:
+        bert_model = BertModel(BertConfig(num_hidden_layers=opts.bert_layers))
+    resnet_model = getattr(torchvision.models, opts.resnet_type)()
+    if config.get('freeze_bert_layers') == 'half':
+        config['freeze_bert_layers'] = bert_model.config.num_hidden_layers // 2
+    args = make_args(
+        resnet_type=opts.resnet_type,
+        img_hidden_sz=resnet_model.fc.in_features,
+        text_hidden_sz=bert_model.config.hidden_size,
+        n_classes=25,
+        device='cuda' if torch.cuda.is_available() else 'cpu',
+        **config)
+    model = tf.build_model('multimodel', args, bert_model, resnet_model).to(args.device)
+    del bert_model, resnet_model
+    tf.freeze_encoders(model, *tf.freeze_levels(args, 0))
+    optimizer = optim.AdamW([p for p in model.parameters() if p.requires_grad], lr=1e-5)
+    criterion = torch.nn.BCEWithLogitsLoss()
+
+    batch_sz, seq_len = opts.batch_sz, opts.max_seq_len
+    txt = torch.randint(1000, (batch_sz, seq_len), device=args.device)
+    mask = torch.ones_like(txt)
+    segment = torch.zeros_like(txt)
+    img = torch.randn(batch_sz, 3, 224, 224, device=args.device)
+    tgt = torch.randint(2, (batch_sz, args.n_classes), device=args.device).float()
+
+    model.train()
+    timings = []
+    for _ in range(opts.steps):
+        start = time.perf_counter()
+        loss = criterion(model(txt, mask, segment, img), tgt)
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+        if args.device == 'cuda':
+            torch.cuda.synchronize()
+        timings.append(time.perf_counter() - start)
+    result = {
+        'trainable_params': sum(p.numel() for p in model.parameters() if p.requires_grad),
+        'step_s': min(timings[1:] or timings),
+        'peak_rss_mb': tf.peak_rss_mb(),
+        'bn_buffers': [b.double().sum().item() for m in model.modules()
+                       if isinstance(m, torch.nn.modules.batchnorm._BatchNorm) for b in m.buffers(recurse=False)],
+    }
+    if args.device == 'cuda':
+        result['peak_cuda_mb'] = torch.cuda.max_memory_allocated() / 2 ** 20
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bert-type', default=None, help='local BERT directory; an untrained bert-base layout otherwise')
+    parser.add_argument('--bert-layers', type=int, default=12)
+    parser.add_argument('--resnet-type', default='resnet152')
+    parser.add_argument('--batch-sz', type=int, default=8)
+    parser.add_argument('--max-seq-len', type=int, default=128)
+    parser.add_argument('--steps', type=int, default=3)
+    parser.add_argument('--configs', nargs='+', default=[name for name, _ in CONFIGS])
+    parser.add_argument('--config', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--out', default=None, help=argparse.SUPPRESS)
+    opts = parser.parse_args()
+
+    if opts.config is not None:
+        with open(opts.out, 'w') as f:
+            json.dump(run_config(opts, dict(CONFIGS)[opts.config]), f)
+        return
+
+    print('{:18s} {:>12s} {:>10s} {:>12s} {:>12s}'.format('config', 'trainable', 'step s', 'peak RSS MB', 'peak CUDA MB'))
+    results = {}
+    with tempfile.TemporaryDirectory() as path:
+        for name in opts.configs:
+            out = os.path.join(path, name + '.json')
+            subprocess.run([sys.executable, '-m', 'benchmarks.bench_finetune_memory', '--config', name, '--out', out] + sys.argv[1:],
+                           check=True)
+            with open(out) as f:
+                r = results[name] = json.load(f)
+            print('{:18s} {:12d} {:10.2f} {:12.0f} {:>12s}'.format(
+                name, r['trainable_params'], r['step_s'], r['peak_rss_mb'],
+                '{:.0f}'.format(r['peak_cuda_mb']) if 'peak_cuda_mb' in r else '-'))
+    for name, r in results.items():
+        base = results.get(name[:-len('+ckpt')]) if name.endswith('+ckpt') else None
+        if base is not None:
+            assert np.allclose(r['bn_buffers'], base['bn_buffers'], rtol=1e-4), \
+                '{}: BatchNorm running stats differ from the run without checkpointing'.format(name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+
+# Samples/sec of a full train-loader epoch for each dataset backend.
+#
+#   python -m benchmarks.bench_loader --n-samples 512 --workers 0 2
+
+import argparse
+import os
+import tempfile
+import time
+
+
+def epoch_throughput(data_path, bert_path, n_workers, batch_sz, **options):
+    import train_functions as tf
+    from benchmarks.common import make_args
+
+    args = make_args(bert_type=bert_path, n_workers=n_workers, batch_sz=batch_sz, **options)
+    train_loader, _, _, args = tf.get_dataloader(data_path, args)
+    n = 0
+    start = time.perf_counter()
+    for batch in train_loader:
+        n += len(batch[-1])
+    return n / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n-samples', type=int, default=512)
+    parser.add_argument('--batch-sz', type=int, default=16)
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 2])
+    opts = parser.parse_args()
+
+    import get_datasets as gd
+    from benchmarks.common import make_synthetic_dataset, make_tiny_bert
+
+    with tempfile.TemporaryDirectory() as workdir:
+        token_cache_dir = os.path.join(workdir, 'tokens')
+        backends = [
+            ('jpeg', {}),
+            ('image_shard', {'image_shard': True}),
+            ('shard+tokens', {'image_shard': True, 'token_cache_dir': token_cache_dir}),
+        ]
+
+        bert_path = make_tiny_bert(os.path.join(workdir, 'bert'))
+        data_path = make_synthetic_dataset(os.path.join(workdir, 'data'), n_train=opts.n_samples,
+                                           img_size=(640, 480))
+        start = time.perf_counter()
+        gd.write_image_shard(data_path)
+        print('write_image_shard: {:.2f}s'.format(time.perf_counter() - start))
+
+        print('{:<16}{:>10}{:>14}'.format('backend', 'workers', 'samples/s'))
+        for name, options in backends:
+            for n_workers in opts.workers:
+                rate = epoch_throughput(data_path, bert_path, n_workers, opts.batch_sz, **options)
+                print('{:<16}{:>10}{:>14.1f}'.format(name, n_workers, rate))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+
+# Per-step time and peak memory of the four model types, with and without
+# modality-aware execution.
+#
+# "before" reproduces the old behaviour: the dataset decodes both modalities and
+# the unused encoders still run (twice over for MultimodalModelAvg, whose text
+# and image submodels each ran BERT and ResNet, so its "before" column is the
+# old two-BERT/two-ResNet step). "after" is the current code.
+# Every measurement runs in a fresh process so peak RSS is not shared.
+#
+#   python -m benchmarks.bench_modality --steps 10 --batch-sz 8
+
+import argparse
+import multiprocessing as mp
+import os
+import tempfile
+import time
+
+MODEL_TYPES = ['multimodel_avg', 'multimodel', 'text', 'image']
+
+
+def run(model_type, mode, workdir, opts, queue):
+    import torch
+    import torch.nn as nn
+    import torchvision
+    from transformers import BertModel
+
+    import train_functions as tf
+    from benchmarks.common import make_args, peak_rss_mb
+
+    torch.manual_seed(0)
+    args = make_args(bert_type=os.path.join(workdir, 'bert'), batch_sz=opts.batch_sz,
+                     max_seq_len=opts.max_seq_len)
+    args.train_loader, args.val_loader, args.test_loader, args = tf.get_dataloader(
+        os.path.join(workdir, 'data'), args)
+    bert_model = BertModel.from_pretrained(args.bert_type)
+    resnet_model = torchvision.models.resnet18()
+    model = tf.build_model(model_type, args, bert_model, resnet_model)
+
+    extra_txt, extra_img = [], []
+    if mode == 'before':
+        tf.set_modalities(args, ('text', 'img'))
+        if model_type in ('multimodel_avg', 'image'):
+            extra_txt.append(tf.BertEncoder(args, bert_model))
+        if model_type in ('multimodel_avg', 'text'):
+            extra_img.append(tf.ImageEncoder(args, resnet_model))
+    else:
+        tf.set_modalities(args, model.modalities)
+
+    params = nn.ModuleList([model] + extra_txt + extra_img).parameters()
+    optimizer = torch.optim.AdamW(params, lr=args.lr)
+    model.train()
+
+    times = []
+    loader = iter(args.train_loader)
+    for step in range(opts.steps + 1):
+        start = time.perf_counter()
+        txt, segment, mask, img, tgt = next(loader)
+        out = model(txt, mask, segment, img)
+        loss = nn.functional.binary_cross_entropy_with_logits(out, tgt)
+        for enc in extra_txt:
+            loss = loss + 0 * enc(txt, mask, segment).sum()
+        for enc in extra_img:
+            loss = loss + 0 * enc(img).sum()
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+        if step > 0:
+            times.append(time.perf_counter() - start)
+
+    queue.put((sum(times) / len(times), peak_rss_mb()))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--steps', type=int, default=10)
+    parser.add_argument('--batch-sz', type=int, default=8)
+    parser.add_argument('--max-seq-len', type=int, default=128)
+    parser.add_argument('--n-samples', type=int, default=128)
+    parser.add_argument('--models', nargs='+', default=MODEL_TYPES, choices=MODEL_TYPES)
+    opts = parser.parse_args()
+
+    from benchmarks.common import make_synthetic_dataset, make_tiny_bert
+
+    ctx = mp.get_context('spawn')
+    with tempfile.TemporaryDirectory() as workdir:
+        make_tiny_bert(os.path.join(workdir, 'bert'))
+        make_synthetic_dataset(os.path.join(workdir, 'data'), n_train=opts.n_samples)
+
+        print('{:<16}{:>14}{:>14}{:>14}{:>14}'.format(
+            'model', 'before s/step', 'after s/step', 'before MB', 'after MB'))
+        for model_type in opts.models:
+            results = {}
+            for mode in ('before', 'after'):
+                queue = ctx.Queue()
+                proc = ctx.Process(target=run, args=(model_type, mode, workdir, opts, queue))
+                proc.start()
+                results[mode] = queue.get()
+                proc.join()
+            print('{:<16}{:>14.4f}{:>14.4f}{:>14.1f}{:>14.1f}'.format(
+                model_type, results['before'][0], results['after'][0],
+                results['before'][1], results['after'][1]))
+
+
+if __name__ == '__main__':
+    main()
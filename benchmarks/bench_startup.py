@@ -0,0 +1,140 @@
+
+# Cold start of a fresh interpreter: to `import train_functions`, to the end of
+# the first training step of a multimodel (data, encoders from the weights
+# cache, model, one optimizer step) and to the first prediction of
+# inference.Predictor. Everything runs offline (HF_HUB_OFFLINE=1) from a
+# weights cache filled beforehand with a bert-base sized BERT and a ResNet with
+# random weights. The OS page cache is warm after the first repeat.
+#
+#   python -m benchmarks.bench_startup --resnet-type resnet152 --repeat 3
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+BERT_TYPE = 'bert-base-uncased'
+
+
+def fill_cache(workdir, opts):
+    import torch
+    import torchvision
+    import safetensors.torch
+
+    from benchmarks.common import make_synthetic_dataset, make_tiny_bert
+
+    cache_dir = os.path.join(workdir, 'weights')
+    bert_dir = os.path.join(cache_dir, 'bert', BERT_TYPE)
+    if not os.path.exists(os.path.join(bert_dir, 'config.json')):
+        make_tiny_bert(bert_dir, hidden_sz=768, n_layers=12)
+    resnet_dir = os.path.join(cache_dir, 'resnet', opts.resnet_type)
+    if not os.path.exists(resnet_dir):
+        os.makedirs(resnet_dir)
+        model = getattr(torchvision.models, opts.resnet_type)()
+        safetensors.torch.save_file(model.state_dict(), os.path.join(resnet_dir, 'model.safetensors'))
+    data_path = os.path.join(workdir, 'data')
+    if not os.path.exists(os.path.join(data_path, 'test.jsonl')):
+        make_synthetic_dataset(data_path, n_train=32, n_val=8, n_test=8)
+
+
+def stage_import(opts, marks):
+    import train_functions  # noqa: F401
+    marks['import'] = time.time()
+
+
+def stage_train(opts, marks):
+    import torch
+    import torch.optim as optim
+
+    import train_functions as tf
+    from benchmarks.common import make_args
+    marks['import'] = time.time()
+
+    cache_dir = os.path.join(opts.workdir, 'weights')
+    args = make_args(bert_type=BERT_TYPE, weights_cache_dir=cache_dir, resnet_type=opts.resnet_type,
+                     batch_sz=opts.batch_sz, max_seq_len=128)
+    tf.get_device(args)
+    args.train_loader, args.val_loader, args.test_loader, args = tf.get_dataloader(os.path.join(opts.workdir, 'data'), args)
+    args.criterion = tf.make_criterion(args)
+    marks['data'] = time.time()
+
+    bert_model = tf.load_bert(args.bert_type, cache_dir)
+    resnet_model = tf.load_resnet(args.resnet_type, cache_dir)
+    args.text_hidden_sz = bert_model.config.hidden_size
+    args.img_hidden_sz = resnet_model.fc.in_features
+    model = tf.build_model('multimodel', args, bert_model, resnet_model).to(args.device)
+    optimizer = optim.AdamW(model.parameters(), lr=args.lr)
+    marks['model'] = time.time()
+
+    txt, segment, mask, img, tgt = tf.batch_to_device(next(iter(args.train_loader)), args.device)
+    loss = args.criterion(model(txt, mask, segment, img), tgt)
+    loss.backward()
+    optimizer.step()
+    marks['first_step'] = time.time()
+
+    savedir = os.path.join(opts.workdir, 'save')
+    os.makedirs(savedir, exist_ok=True)
+    tf.save_args(args, os.path.join(savedir, 'args.pt'))
+    torch.save({'state_dict': model.state_dict(), 'model_type': 'multimodel'}, os.path.join(savedir, 'model_best.pt'))
+
+
+def stage_infer(opts, marks):
+    import inference
+    marks['import'] = time.time()
+
+    predictor = inference.Predictor(os.path.join(opts.workdir, 'save'), device='cpu')
+    marks['model'] = time.time()
+    data_path = os.path.join(opts.workdir, 'data')
+    with open(os.path.join(data_path, 'test.jsonl')) as f:
+        record = json.loads(f.readline())
+    next(predictor.predict([record], data_dir=data_path))
+    marks['first_prediction'] = time.time()
+
+
+STAGES = {'import': stage_import, 'train': stage_train, 'infer': stage_infer}
+
+
+def run_stage(opts, name):
+    env = dict(os.environ, HF_HUB_OFFLINE='1', TRANSFORMERS_OFFLINE='1', OMP_NUM_THREADS=str(opts.threads))
+    start = time.time()
+    out = subprocess.run([sys.executable, '-m', 'benchmarks.bench_startup', '--stage', name, '--start', repr(start)] + sys.argv[1:],
+                         env=env, check=True, stdout=subprocess.PIPE).stdout.decode()
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workdir', default=None, help='keep the data and the weights cache here between runs')
+    parser.add_argument('--resnet-type', default='resnet152')
+    parser.add_argument('--batch-sz', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--stage', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--start', type=float, default=None, help=argparse.SUPPRESS)
+    opts = parser.parse_args()
+
+    if opts.stage is not None:
+        import torch
+        torch.set_num_threads(opts.threads)
+        marks = {}
+        STAGES[opts.stage](opts, marks)
+        print(json.dumps({k: v - opts.start for k, v in marks.items()}))
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        opts.workdir = opts.workdir or tmp
+        fill_cache(opts.workdir, opts)
+        sys.argv += ['--workdir', opts.workdir]
+        for name in STAGES:
+            runs = [run_stage(opts, name) for _ in range(opts.repeat)]
+            print('{:7s} '.format(name) + '  '.join(
+                '{} {:.2f}s'.format(k, np.median([r[k] for r in runs])) for k in runs[0]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+
+# Checks find_thresholds_f1 against the per-column find_threshold_f1 loop and
+# times both.
+#
+#   python -m benchmarks.bench_thresholds --n-samples 5000 --n-classes 80
+
+import argparse
+import time
+
+import numpy as np
+
+import train_functions as tf
+
+
+def loop_thresholds(trues, preds):
+    f1_scores, thresholds = [], []
+    for i in range(trues.shape[1]):
+        f1, threshold = tf.find_threshold_f1(trues[:, i], preds[:, i], eps=1e-9)
+        f1_scores.append(f1)
+        thresholds.append(threshold)
+    return np.array(f1_scores), np.array(thresholds)
+
+
+def make_case(rng, n_samples, n_classes, decimals=None):
+    trues = (rng.rand(n_samples, n_classes) < rng.uniform(0.01, 0.5, n_classes)).astype(np.float32)
+    preds = np.clip(trues * 0.3 + rng.rand(n_samples, n_classes) * 0.7, 0, 1).astype(np.float32)
+    if decimals is not None:
+        # coarse scores produce many ties
+        preds = np.round(preds, decimals)
+    trues[:, 0] = 0
+    trues[:, 1] = 1
+    return trues, preds
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n-samples', type=int, default=5000)
+    parser.add_argument('--n-classes', type=int, default=80)
+    opts = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    for n_samples, n_classes, decimals in [(50, 10, 1), (500, 23, 2), (1000, 80, None)]:
+        trues, preds = make_case(rng, n_samples, n_classes, decimals)
+        expected = loop_thresholds(trues, preds)
+        got = tf.find_thresholds_f1(trues, preds)
+        assert np.array_equal(expected[0], got[0]), (n_samples, n_classes, decimals)
+        assert np.array_equal(expected[1], got[1]), (n_samples, n_classes, decimals)
+    print('find_thresholds_f1 matches find_threshold_f1')
+
+    trues, preds = make_case(rng, opts.n_samples, opts.n_classes)
+    start = time.perf_counter()
+    loop_thresholds(trues, preds)
+    loop = time.perf_counter() - start
+    start = time.perf_counter()
+    tf.find_thresholds_f1(trues, preds)
+    vectorized = time.perf_counter() - start
+    print('{} x {}: loop {:.3f}s, vectorized {:.3f}s ({:.1f}x)'.format(
+        opts.n_samples, opts.n_classes, loop, vectorized, loop / vectorized))
+
+
+if __name__ == '__main__':
+    main()
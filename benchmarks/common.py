@@ -0,0 +1,110 @@
+
+import json
+import os
+import string
+from argparse import Namespace
+
+import numpy as np
+from PIL import Image
+
+
+def make_args(**kwargs):
+    args = Namespace()
+    args.max_seq_len = 512
+    args.batch_sz = 4
+    args.n_workers = 0
+    args.img_embed_pool_type = 'avg'
+    args.num_image_embeds = 1
+    args.lr = 1e-5
+    args.lr_patience = 2
+    args.lr_factor = 0.5
+    args.max_epochs = 1
+    args.gradient_accumulation_steps = 1
+    args.patience = 10
+    args.resnet_type = 'resnet18'
+    args.img_hidden_sz = 512
+    args.text_hidden_sz = 128
+    args.linear_layer_dim = 10
+    args.linear_layer_count = 0
+    for k, v in kwargs.items():
+        setattr(args, k, v)
+    return args
+
+
+def make_tiny_bert(path, hidden_sz=128, n_layers=2):
+    # A randomly initialised BERT saved in the layout `from_pretrained` expects,
+    # so `args.bert_type` can point at it and everything runs offline.
+    from transformers import BertConfig, BertModel
+
+    os.makedirs(path, exist_ok=True)
+    words = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]']
+    words += list(string.ascii_lowercase)
+    words += [a + b for a in string.ascii_lowercase for b in string.ascii_lowercase]
+    with open(os.path.join(path, 'vocab.txt'), 'w') as f:
+        f.write('\n'.join(words) + '\n')
+
+    config = BertConfig(
+        vocab_size=len(words),
+        hidden_size=hidden_sz,
+        num_hidden_layers=n_layers,
+        num_attention_heads=2,
+        intermediate_size=hidden_sz * 4,
+    )
+    BertModel(config).save_pretrained(path)
+    return path
+
+
+def make_synthetic_dataset(path, n_train=64, n_val=16, n_test=16, n_labels=8,
+                           min_words=8, max_words=200, img_size=(320, 240), seed=0):
+    rng = np.random.RandomState(seed)
+    os.makedirs(os.path.join(path, 'dataset'), exist_ok=True)
+    labels = ['label_{}'.format(i) for i in range(n_labels)]
+    letters = np.array(list(string.ascii_lowercase))
+
+    idx = 0
+    for split, n in (('train', n_train), ('val', n_val), ('test', n_test)):
+        with open(os.path.join(path, split + '.jsonl'), 'w') as f:
+            for _ in range(n):
+                img = 'dataset/{}.jpeg'.format(idx)
+                pixels = rng.randint(0, 255, (img_size[1], img_size[0], 3), dtype=np.uint8)
+                Image.fromarray(pixels).save(os.path.join(path, img))
+                n_words = rng.randint(min_words, max_words + 1)
+                text = ' '.join(
+                    ''.join(rng.choice(letters, 2)) for _ in range(n_words)
+                )
+                label = list(rng.choice(labels, rng.randint(1, 4), replace=False))
+                f.write(json.dumps({'label': label, 'img': img, 'text': text}) + '\n')
+                idx += 1
+    return path
+
+
+def peak_rss_mb():
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def make_tiny_savedir(path, data_path, bert_path, model_type='multimodel', resnet_type='resnet18'):
+    # A save directory in the layout main() writes (args.pt, model_best.pt,
+    # thresholds.json) holding an untrained model, for inference benchmarks.
+    import torch
+    import torchvision
+    from transformers import BertModel
+
+    import train_functions as tf
+
+    labels = []
+    with open(os.path.join(data_path, 'train.jsonl')) as f:
+        for line in f:
+            labels.extend(l for l in json.loads(line)['label'] if l not in labels)
+
+    bert_model = BertModel.from_pretrained(bert_path)
+    resnet_model = getattr(torchvision.models, resnet_type)()
+    args = make_args(bert_type=bert_path, resnet_type=resnet_type, labels=labels, n_classes=len(labels),
+                     text_hidden_sz=bert_model.config.hidden_size)
+    model = tf.build_model(model_type, args, bert_model, resnet_model)
+
+    os.makedirs(path, exist_ok=True)
+    tf.save_args(args, os.path.join(path, 'args.pt'))
+    torch.save({'state_dict': model.state_dict(), 'model_type': model_type}, os.path.join(path, 'model_best.pt'))
+    tf.save_thresholds(labels, [0.5] * len(labels), path)
+    return path
@@ -0,0 +1,89 @@
+
+# Closed-loop load test for serve.py: --concurrency clients send requests back
+# to back for --duration seconds and the script reports QPS and latency
+# percentiles.
+#
+#   python -m benchmarks.load_test --url http://127.0.0.1:8000   # running server
+#   python -m benchmarks.load_test                               # in-process server on a tiny synthetic model
+
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+import urllib.request
+
+import numpy as np
+
+
+def client(url, records, deadline, latencies, errors):
+    i = 0
+    while time.monotonic() < deadline:
+        body = json.dumps(records[i % len(records)]).encode()
+        request = urllib.request.Request(url + '/predict', data=body, headers={'Content-Type': 'application/json'})
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request) as response:
+                response.read()
+            latencies.append(time.perf_counter() - start)
+        except Exception:
+            errors.append(1)
+        i += 1
+
+
+def run(url, records, concurrency, duration):
+    latencies, errors = [], []
+    deadline = time.monotonic() + duration
+    threads = [threading.Thread(target=client, args=(url, records[i::concurrency] or records, deadline, latencies, errors))
+               for i in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    latencies = np.array(latencies) * 1000
+    print('concurrency={:<4} requests={:<6} errors={:<4} QPS={:>8.1f}  p50={:>7.1f}ms  p99={:>7.1f}ms'.format(
+        concurrency, len(latencies), len(errors), len(latencies) / elapsed,
+        np.percentile(latencies, 50), np.percentile(latencies, 99)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default=None)
+    parser.add_argument('--data', default=None, help='JSONL of records to send (img paths relative to the server --data-dir)')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--model-type', default='multimodel')
+    parser.add_argument('--max-batch-size', type=int, default=16)
+    parser.add_argument('--max-wait-ms', type=float, default=5)
+    opts = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        server = None
+        data = opts.data
+        if opts.url is None:
+            import serve
+            from benchmarks.common import make_synthetic_dataset, make_tiny_bert, make_tiny_savedir
+
+            bert_path = make_tiny_bert(os.path.join(workdir, 'bert'))
+            data_path = make_synthetic_dataset(os.path.join(workdir, 'data'), n_train=32, n_val=0, n_test=64)
+            savedir = make_tiny_savedir(os.path.join(workdir, 'save'), data_path, bert_path, opts.model_type)
+            data = os.path.join(data_path, 'test.jsonl')
+            server = serve.make_server(savedir, port=0, device='cpu', max_batch_size=opts.max_batch_size,
+                                       max_wait_ms=opts.max_wait_ms, data_dir=data_path)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            opts.url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+        with open(data) as f:
+            records = [{'text': r['text'], 'img': r['img']} for r in map(json.loads, f)]
+        for concurrency in opts.concurrency:
+            run(opts.url, records, concurrency, opts.duration)
+
+        if server is not None:
+            server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+
+# Reproducible CPU benchmark of the data pipeline and the four model types on
+# synthetic data (benchmarks.common), with tiny BERT and untrained ResNet
+# encoders, so no download is needed. Results go to a JSON file; `compare`
+# reports the change between two of them and exits with 1 when a benchmark
+# got slower than the threshold. Compare runs from the same machine and
+# settings; on a busy machine use more --repeat or `compare --stat min_ms`.
+#
+#   python -m benchmarks.suite run --out base.json
+#   python -m benchmarks.suite run --out new.json
+#   python -m benchmarks.suite compare base.json new.json --threshold 0.1
+
+import argparse
+import functools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+MODEL_TYPES = ['multimodel', 'multimodel_avg', 'text', 'image']
+
+
+def measure(fn, repeat, warmup=1):
+    for _ in range(warmup):
+        fn()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    timings = np.array(timings) * 1000
+    return {'median_ms': float(np.median(timings)), 'min_ms': float(timings.min()), 'repeat': repeat}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(workdir, opts):
+    import torch
+    import torch.optim as optim
+    import torchvision
+    from transformers import BertModel
+
+    import train_functions as tf
+    from benchmarks.common import make_args, make_synthetic_dataset, make_tiny_bert
+
+    torch.set_num_threads(opts.threads)
+    bert_path = os.path.join(workdir, 'bert')
+    data_path = os.path.join(workdir, 'data')
+    if not os.path.exists(os.path.join(bert_path, 'config.json')):
+        make_tiny_bert(bert_path)
+    if not os.path.exists(os.path.join(data_path, 'test.jsonl')):
+        make_synthetic_dataset(data_path, n_train=opts.n_train, n_val=8, n_test=8, max_words=opts.max_words)
+
+    args = make_args(bert_type=bert_path, batch_sz=opts.batch_sz, max_seq_len=opts.max_seq_len, device='cpu')
+    tf.get_device(args)
+    args.train_loader, args.val_loader, args.test_loader, args = tf.get_dataloader(data_path, args)
+    args.criterion = tf.make_criterion(args)
+    dataset = args.train_loader.dataset
+    results = {}
+
+    torch.manual_seed(0)
+    order = np.random.RandomState(0).permutation(len(dataset))
+    counter = iter(range(10 ** 9))
+
+    def getitem():
+        return dataset[int(order[next(counter) % len(dataset)])]
+    results['dataset_getitem'] = measure(getitem, opts.repeat * 5)
+
+    batch = [dataset[int(i)] for i in order[:opts.batch_sz]]
+    results['collate_fn'] = measure(functools.partial(tf.collate_fn, batch, args), opts.repeat * 5)
+
+    def loader_epoch():
+        for _ in args.train_loader:
+            pass
+    results['loader_epoch'] = measure(loader_epoch, max(opts.repeat // 5, 1))
+
+    bert_model = BertModel.from_pretrained(bert_path)
+    resnet_model = torchvision.models.resnet18()
+    full_batch = tf.collate_fn(batch, args)
+    for model_type in MODEL_TYPES:
+        torch.manual_seed(0)
+        model = tf.build_model(model_type, args, *tf.fresh_encoders(model_type, bert_model, resnet_model))
+        optimizer = optim.AdamW(model.parameters(), lr=1e-5)
+        txt, segment, mask, img, tgt = full_batch
+        if 'text' not in model.modalities:
+            txt, segment, mask = None, None, None
+        if 'img' not in model.modalities:
+            img = None
+
+        def forward():
+            with torch.no_grad():
+                model(txt, mask, segment, img)
+
+        def train_step():
+            loss = args.criterion(model(txt, mask, segment, img), tgt)
+            loss.backward()
+            optimizer.step()
+            optimizer.zero_grad()
+
+        model.eval()
+        results['forward.' + model_type] = measure(forward, opts.repeat)
+        model.train()
+        results['train_step.' + model_type] = measure(train_step, opts.repeat)
+    return results
+
+
+def run(opts):
+    import torch
+
+    if opts.workdir:
+        os.makedirs(opts.workdir, exist_ok=True)
+        results = run_suite(opts.workdir, opts)
+    else:
+        with tempfile.TemporaryDirectory() as workdir:
+            results = run_suite(workdir, opts)
+    out = {
+        'meta': {
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'config': {k: v for k, v in vars(opts).items() if k not in ('command', 'out', 'workdir')},
+        },
+        'results': results,
+    }
+    with open(opts.out, 'w') as f:
+        json.dump(out, f, indent=1)
+    for name, r in results.items():
+        print('{:28s} {:10.3f} ms'.format(name, r['median_ms']))
+
+
+def compare(opts):
+    with open(opts.base) as f:
+        base = json.load(f)
+    with open(opts.new) as f:
+        new = json.load(f)
+    if base['meta']['config'] != new['meta']['config']:
+        print('warning: the two runs used different settings')
+    regressions = []
+    print('{:28s} {:>10s} {:>10s} {:>8s}'.format('benchmark', 'base ms', 'new ms', 'change'))
+    for name in sorted(set(base['results']) | set(new['results'])):
+        if name not in base['results'] or name not in new['results']:
+            print('{:28s} only in {}'.format(name, 'base' if name in base['results'] else 'new'))
+            continue
+        b, n = base['results'][name][opts.stat], new['results'][name][opts.stat]
+        change = n / b - 1
+        flag = ''
+        if change > opts.threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print('{:28s} {:10.3f} {:10.3f} {:+7.1%}{}'.format(name, b, n, change, flag))
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run')
+    run_parser.add_argument('--out', default='benchmark_results.json')
+    run_parser.add_argument('--workdir', default=None, help='keep the synthetic data and tiny BERT here between runs')
+    run_parser.add_argument('--repeat', type=int, default=10)
+    run_parser.add_argument('--threads', type=int, default=1)
+    run_parser.add_argument('--batch-sz', type=int, default=8)
+    run_parser.add_argument('--n-train', type=int, default=64)
+    run_parser.add_argument('--max-words', type=int, default=200)
+    run_parser.add_argument('--max-seq-len', type=int, default=128)
+    compare_parser = commands.add_parser('compare')
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=0.1, help='allowed relative slowdown')
+    compare_parser.add_argument('--stat', choices=['median_ms', 'min_ms'], default='median_ms',
+                                help='min_ms is less sensitive to a noisy machine')
+    opts = parser.parse_args()
+
+    if opts.command == 'run':
+        run(opts)
+    else:
+        sys.exit(compare(opts))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+
+import argparse
+import itertools
+import json
+import os
+import time
+from argparse import Namespace
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+
+import pandas as pd
+import torch
+
+import train_functions as tf
+
+GRID_KEYS = ['bert_type', 'resnet_type', 'linear_layer_dim', 'linear_layer_count', 'model_type']
+
+
+def make_grid(**options):
+    # make_grid(bert_type=[...], model_type=[...], ...) -> one config dict per
+    # combination; keys not given are taken from the base args.
+    keys = list(options)
+    return [dict(zip(keys, values)) for values in itertools.product(*[options[k] for k in keys])]
+
+
+def run_name(config):
+    return '_'.join(str(config[k]).replace('/', '-').strip('-') for k in GRID_KEYS)
+
+
+class ExperimentRunner(object):
+    # Keeps what is expensive to rebuild between runs: the dataloaders (with
+    # their tokenizer and vocab) per bert_type, and the pretrained encoders per
+    # bert_type / resnet_type. Each run trains on its own copy of the encoders.
+    def __init__(self, args, dataset_path, savedir, results_path=None):
+        self.args = args
+        self.dataset_path = dataset_path
+        self.savedir = savedir
+        self.results_path = results_path or os.path.join(savedir, 'results.csv')
+        self.data = {}
+        self.bert_models = {}
+        self.resnet_models = {}
+        self.feature_loaders = {}
+        self.results = []
+        tf.get_device(args)
+
+    def load_results(self):
+        # Runs already in the results table are done and are not run again.
+        if os.path.exists(self.results_path):
+            self.results = pd.read_csv(self.results_path).to_dict('records')
+
+    def full_config(self, config):
+        return {k: config.get(k, getattr(self.args, k, None)) for k in GRID_KEYS}
+
+    def pending(self, grid):
+        done = set(row['run'] for row in self.results)
+        return [config for config in grid if run_name(self.full_config(config)) not in done]
+
+    def get_bert(self, bert_type):
+        if bert_type not in self.bert_models:
+            self.bert_models[bert_type] = tf.load_bert(bert_type, tf.weights_cache_dir(self.args))
+        return self.bert_models[bert_type]
+
+    def get_resnet(self, resnet_type):
+        if resnet_type not in self.resnet_models:
+            self.resnet_models[resnet_type] = tf.load_resnet(resnet_type, tf.weights_cache_dir(self.args))
+        return self.resnet_models[resnet_type]
+
+    def get_data(self, bert_type):
+        # The tokenizer is the only part of the data pipeline that depends on
+        # the run config.
+        if bert_type not in self.data:
+            args = Namespace(**vars(self.args))
+            args.bert_type = bert_type
+            args.train_loader, args.val_loader, args.test_loader, args = tf.get_dataloader(self.dataset_path, args)
+            args.criterion = tf.make_criterion(args)
+            self.data[bert_type] = args
+        return self.data[bert_type]
+
+    def make_args(self, config):
+        args = Namespace(**vars(self.get_data(self.full_config(config)['bert_type'])))
+        for k, v in config.items():
+            setattr(args, k, v)
+        args.text_hidden_sz = self.get_bert(args.bert_type).config.hidden_size
+        args.img_hidden_sz = self.get_resnet(args.resnet_type).fc.in_features
+        return args
+
+    def get_feature_loaders(self, args):
+        key = (args.bert_type, args.resnet_type)
+        if key not in self.feature_loaders:
+            bert_model, resnet_model = self.get_bert(args.bert_type), self.get_resnet(args.resnet_type)
+            self.feature_loaders[key] = tf.get_feature_loaders(
+                self.dataset_path, *tf.fresh_encoders('multimodel', bert_model, resnet_model), args)
+        return self.feature_loaders[key]
+
+    def run(self, config):
+        args = self.make_args(config)
+        config = {k: getattr(args, k) for k in GRID_KEYS}
+        name = run_name(config)
+        savedir = os.path.join(self.savedir, name)
+        os.makedirs(savedir, exist_ok=True)
+
+        bert_model, resnet_model = self.get_bert(args.bert_type), self.get_resnet(args.resnet_type)
+        use_feature_cache = getattr(args, 'feature_cache_dir', None) is not None
+        if use_feature_cache:
+            args.train_loader, args.val_loader, args.test_loader = self.get_feature_loaders(args)
+
+        print(tf.MODEL_NAMES[args.model_type], config)
+        if use_feature_cache:
+            model = tf.use_precomputed_features(tf.build_model(args.model_type, args, bert_model, resnet_model))
+        else:
+            model = tf.build_model(args.model_type, args, *tf.fresh_encoders(args.model_type, bert_model, resnet_model))
+        model = model.to(args.device)
+        tf.set_modalities(args, model.modalities)
+
+        start = time.time()
+        params, test_metrics = tf.train_and_evaluate(model, args, savedir)
+        row = dict(config, run=name, params_count=int(params), test_loss=test_metrics['loss'],
+                   test_macro_f1=test_metrics['macro_f1'], train_time_s=time.time() - start, savedir=savedir)
+        return row
+
+    def record(self, row):
+        # Rewritten after every run so a partial grid still leaves a table; the
+        # rename keeps a killed sweep from leaving a truncated one.
+        self.results.append(row)
+        pd.DataFrame(self.results).to_csv(self.results_path + '.tmp', index=False)
+        os.replace(self.results_path + '.tmp', self.results_path)
+
+    def run_grid(self, grid):
+        self.load_results()
+        for config in self.pending(grid):
+            self.record(self.run(config))
+        return pd.DataFrame(self.results)
+
+
+def run_grid(args, dataset_path, grid, savedir, results_path=None):
+    return ExperimentRunner(args, dataset_path, savedir, results_path).run_grid(grid)
+
+
+_runner = None
+
+
+def _init_worker(args, dataset_path, savedir, n_threads):
+    global _runner
+    torch.set_num_threads(n_threads)
+    _runner = ExperimentRunner(args, dataset_path, savedir)
+
+
+def _run_config(config):
+    return _runner.run(config)
+
+
+def run_sweep(args, dataset_path, grid, savedir, n_procs=2, n_threads=None, results_path=None):
+    # Spreads the grid over n_procs processes with n_threads torch threads
+    # each. Every process builds its own runner, but the tokenized splits
+    # (and the feature cache, if used) are written here first, so the
+    # processes share them read-only through mmap, and so is the weights
+    # cache, if used. Results are recorded here as runs finish, and a
+    # restarted sweep skips the runs already recorded. A run that fails is
+    # reported and left out of the table, so a restarted sweep retries it.
+    n_threads = n_threads or max(1, (os.cpu_count() or 1) // n_procs)
+    if getattr(args, 'token_cache_dir', None) is None:
+        args.token_cache_dir = os.path.join(savedir, 'token_cache')
+    runner = ExperimentRunner(args, dataset_path, savedir, results_path)
+    runner.load_results()
+    pending = runner.pending(grid)
+    for config in pending:
+        if getattr(args, 'feature_cache_dir', None) is not None:
+            runner.get_feature_loaders(runner.make_args(config))
+        else:
+            runner.get_data(runner.full_config(config)['bert_type'])
+        if tf.weights_cache_dir(args) is not None:
+            tf.resnet_path(runner.full_config(config)['resnet_type'], tf.weights_cache_dir(args))
+    runner.data, runner.bert_models, runner.resnet_models, runner.feature_loaders = {}, {}, {}, {}
+    print('{} runs pending, {} done; {} processes x {} threads'.format(
+        len(pending), len(runner.results), n_procs, n_threads))
+
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(n_procs, mp_context=context, initializer=_init_worker,
+                             initargs=(args, dataset_path, savedir, n_threads)) as pool:
+        futures = {pool.submit(_run_config, config): config for config in pending}
+        failed = []
+        for future in as_completed(futures):
+            try:
+                row = future.result()
+            except Exception as e:
+                failed.append(run_name(runner.full_config(futures[future])))
+                print('Run {} failed: {!r}'.format(failed[-1], e))
+                continue
+            runner.record(row)
+    if failed:
+        print('{} runs failed: {}'.format(len(failed), ', '.join(failed)))
+    return pd.DataFrame(runner.results)
+
+
+if __name__ == '__main__':
+    # python experiments.py config.json
+    # {"dataset_path": "mmimdb", "savedir": "model_save/grid",
+    #  "args": {"max_seq_len": 512, "batch_sz": 4, ...},
+    #  "grid": {"bert_type": [...], "resnet_type": [...], "linear_layer_dim": [...],
+    #           "linear_layer_count": [...], "model_type": [...]}}
+    parser = argparse.ArgumentParser()
+    parser.add_argument('config')
+    parser.add_argument('--procs', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=None, help='torch threads per process')
+    opts = parser.parse_args()
+
+    with open(opts.config) as f:
+        config = json.load(f)
+    args, grid = Namespace(**config['args']), make_grid(**config['grid'])
+    if opts.procs > 1:
+        results = run_sweep(args, config['dataset_path'], grid, config['savedir'], opts.procs,
+                            opts.threads, config.get('results_path'))
+    else:
+        results = run_grid(args, config['dataset_path'], grid, config['savedir'], config.get('results_path'))
+    print(results.to_string(index=False))
@@ -0,0 +1,171 @@
+
+import argparse
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+import train_functions as tf
+from inference import load_model
+
+
+def export_inputs(modalities, txt, mask, segment, img):
+    inputs = ()
+    if 'text' in modalities:
+        inputs += (txt, mask, segment)
+    if 'img' in modalities:
+        inputs += (img,)
+    return inputs
+
+
+class ExportModule(nn.Module):
+    # Exposes only the inputs the model consumes, in the order export_inputs
+    # builds them: (txt, mask, segment) for text, (img,) for images.
+    def __init__(self, model):
+        super(ExportModule, self).__init__()
+        self.model = model
+        self.modalities = model.modalities
+
+    def forward(self, *inputs):
+        txt, mask, segment, img = None, None, None, None
+        if 'text' in self.modalities:
+            txt, mask, segment = inputs[:3]
+            inputs = inputs[3:]
+        if 'img' in self.modalities:
+            img = inputs[0]
+        return self.model(txt, mask, segment, img)
+
+
+class ExportedModel(nn.Module):
+    # Puts a TorchScript module or an onnxruntime session back behind the
+    # model(txt, mask, segment, img) signature, so model_eval can score it.
+    def __init__(self, exported, modalities):
+        super(ExportedModel, self).__init__()
+        self.exported = exported
+        self.modalities = modalities
+
+    def forward(self, txt, mask, segment, img):
+        inputs = export_inputs(self.modalities, txt, mask, segment, img)
+        if isinstance(self.exported, torch.jit.ScriptModule):
+            return self.exported(*inputs)
+        names = [i.name for i in self.exported.get_inputs()]
+        out = self.exported.run(None, {n: x.cpu().numpy() for n, x in zip(names, inputs)})[0]
+        return torch.from_numpy(out).to(txt.device if txt is not None else img.device)
+
+
+def quantize(model):
+    # Dynamic int8 for every nn.Linear: the BERT encoder layers and the clf
+    # heads. ResNet convolutions stay in float32.
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def quantize_onnx(path):
+    # torch's dynamic quantized ops have no ONNX export, so the fp32 graph is
+    # quantized by onnxruntime instead, with the same scope: the MatMul and
+    # Gemm nodes of the Linear layers.
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    fp32_path = path + '.fp32'
+    os.replace(path, fp32_path)
+    quantize_dynamic(fp32_path, path, op_types_to_quantize=['MatMul', 'Gemm'], weight_type=QuantType.QInt8)
+    os.remove(fp32_path)
+
+
+def export(model, example, path, fmt='torchscript'):
+    module = ExportModule(model).eval()
+    with torch.no_grad():
+        if fmt == 'torchscript':
+            traced = torch.jit.trace(module, example, strict=False, check_trace=False)
+            traced = torch.jit.freeze(traced)
+            torch.jit.save(traced, path)
+            return
+        names, dynamic_axes = [], {'logits': {0: 'batch'}}
+        if 'text' in model.modalities:
+            names += ['txt', 'mask', 'segment']
+            dynamic_axes.update({n: {0: 'batch', 1: 'seq'} for n in ['txt', 'mask', 'segment']})
+        if 'img' in model.modalities:
+            names += ['img']
+            dynamic_axes['img'] = {0: 'batch'}
+        torch.onnx.export(module, example, path, input_names=names, output_names=['logits'],
+                          dynamic_axes=dynamic_axes, opset_version=17, dynamo=False)
+
+
+def load_exported(path, modalities, fmt='torchscript'):
+    if fmt == 'onnx':
+        import onnxruntime
+        session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+        return ExportedModel(session, modalities)
+    return ExportedModel(torch.jit.load(path), modalities)
+
+
+def make_example_batch(args, seq_len=64):
+    bsz = args.batch_sz
+    txt = torch.randint(5, 1000, (bsz, seq_len))
+    img = torch.randn(bsz, 3, 224, 224)
+    return txt, torch.zeros_like(txt), torch.ones_like(txt), img, torch.zeros(bsz, args.n_classes)
+
+
+def latency_ms(model, batch, device, repeat=10):
+    txt, segment, mask, img, _ = tf.batch_to_device(batch, device)
+    timings = []
+    with torch.no_grad():
+        model(txt, mask, segment, img)
+        for _ in range(repeat):
+            start = time.perf_counter()
+            model(txt, mask, segment, img)
+            timings.append(time.perf_counter() - start)
+    return np.median(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('savedir')
+    parser.add_argument('--format', choices=['torchscript', 'onnx'], default='torchscript')
+    parser.add_argument('--quantize', action='store_true', help='dynamic int8 BERT and clf layers')
+    parser.add_argument('--out', default=None)
+    parser.add_argument('--check', default=None, help='dataset path: compare macro F1 with fp32 on its test split')
+    parser.add_argument('--batch-sz', type=int, default=None)
+    opts = parser.parse_args()
+
+    state = torch.load(os.path.join(opts.savedir, 'model_best.pt'), map_location='cpu', weights_only=False)
+    args = torch.load(os.path.join(opts.savedir, 'args.pt'), weights_only=False)
+    args.device = torch.device('cpu')
+    args.amp = False
+    if opts.batch_sz:
+        args.batch_sz = opts.batch_sz
+    model = load_model(args, state)
+    exported = quantize(model) if opts.quantize and opts.format == 'torchscript' else model
+
+    if opts.check:
+        _, _, test_loader, args = tf.get_dataloader(opts.check, args)
+        args.criterion = tf.make_criterion(args)
+        test_loader.dataset.modalities = model.modalities
+        example_batch = next(iter(test_loader))
+    else:
+        test_loader = None
+        example_batch = make_example_batch(args)
+
+    suffix = '.int8' if opts.quantize else ''
+    ext = '.onnx' if opts.format == 'onnx' else '.ts'
+    out = opts.out or os.path.join(opts.savedir, 'model_best' + suffix + ext)
+    txt, segment, mask, img, _ = example_batch
+    export(exported, export_inputs(model.modalities, txt, mask, segment, img), out, opts.format)
+    if opts.quantize and opts.format == 'onnx':
+        quantize_onnx(out)
+    print('Exported {} to {}'.format(opts.format, out))
+
+    artifact = load_exported(out, model.modalities, opts.format)
+    print('CPU latency per batch of {}: fp32 {:.1f}ms | exported {:.1f}ms'.format(
+        len(example_batch[-1]), latency_ms(model, example_batch, args.device),
+        latency_ms(artifact, example_batch, args.device)))
+
+    if test_loader is not None:
+        reference = tf.model_eval(np.inf, test_loader, model, args)
+        metrics = tf.model_eval(np.inf, test_loader, artifact, args)
+        print('Test macro F1: fp32 {:.5f} | exported {:.5f} | diff {:+.5f}'.format(
+            reference['macro_f1'], metrics['macro_f1'], metrics['macro_f1'] - reference['macro_f1']))
+
+
+if __name__ == '__main__':
+    main()
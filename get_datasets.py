@@ -6,28 +6,67 @@ import numpy as np
 import os
 from PIL import Image
 Image.MAX_IMAGE_PIXELS = None
-import functools
-from collections import Counter
-from argparse import Namespace
-from transformers import BertTokenizer, BertModel
-from tqdm.notebook import tqdm
-import re
-import pandas as pd
-import torch
-import torchvision
-import torch.nn as nn
-import torch.optim as optim
-import torchvision.transforms as transforms
-from torch.utils.data import Dataset
-from torch.utils.data import DataLoader
-
-import shutil
-from sklearn.metrics import f1_score
-from sklearn.metrics import precision_recall_curve
-import matplotlib.pyplot as plt
-import requests
+from tqdm.auto import tqdm
+
+import multiprocessing
+import concurrent.futures
+import time
+import hashlib
+
+# pandas, requests and torchvision are imported by the steps that use them.
+
+def make_session(n_workers):
+  import requests
+  session = requests.Session()
+  adapter = requests.adapters.HTTPAdapter(pool_connections=n_workers, pool_maxsize=n_workers)
+  session.mount('http://', adapter)
+  session.mount('https://', adapter)
+  return session
+
+def download_file(session, url, path, retries=3, backoff=0.5, timeout=30):
+  # Returns None on success (or if the file is already there), else the error.
+  if os.path.exists(path) and os.path.getsize(path) > 0:
+    return None
+  import requests
+  error = None
+  for attempt in range(retries + 1):
+    try:
+      response = session.get(url, timeout=timeout)
+      if 400 <= response.status_code < 500 and response.status_code != 429:
+        return f'HTTP {response.status_code}'
+      response.raise_for_status()
+      with open(path + '.part', 'wb') as handler:
+        handler.write(response.content)
+      os.replace(path + '.part', path)
+      return None
+    except (requests.RequestException, OSError) as e:
+      error = repr(e)
+    if attempt < retries:
+      time.sleep(backoff * 2 ** attempt)
+  return error
+
+def download_images(jobs, n_workers=16, retries=3, backoff=0.5, manifest_path=None):
+  # jobs is a list of (url, path). Downloads run on a bounded thread pool over
+  # one connection-pooled session, files already on disk are skipped, and the
+  # indices of jobs that still failed after retries are returned and written
+  # to manifest_path as JSONL.
+  session = make_session(n_workers)
+  failed = {}
+  with concurrent.futures.ThreadPoolExecutor(n_workers) as pool:
+    futures = {pool.submit(download_file, session, url, path, retries, backoff): i for i, (url, path) in enumerate(jobs)}
+    for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures)):
+      error = future.result()
+      if error is not None:
+        failed[futures[future]] = error
+
+  if manifest_path is not None:
+    with open(manifest_path, 'w') as f:
+      for i in sorted(failed):
+        f.write(json.dumps({'url': jobs[i][0], 'path': jobs[i][1], 'error': failed[i]}) + "\n")
+  return failed
 
 def write_formated_data_coco(args, captions, instances):
+  import pandas as pd
 
   data = pd.DataFrame(captions['images'])
   captions = pd.DataFrame(captions['annotations'])
@@ -55,19 +94,22 @@ def write_formated_data_coco(args, captions, instances):
 
   data = data.reset_index(drop=True)
 
-  lines = []
-  for i in tqdm(range(len(data))):
-    try:
-      img = requests.get(data.coco_url[i]).content
-      with open(f'''{args.data_path_coco}/dataset/''' + f'''{data['coco_url'][i][38:]}''', 'wb') as handler:
-        handler.write(img)
-      lines.append({'label': list(data.tags[i]), 'img': f'''dataset/{data['coco_url'][i][38:]}''', 'text': data.caption[i][0]})
-    except:
-      pass
+  lines = [{'label': list(data.tags[i]), 'img': f'''dataset/{data['coco_url'][i][38:]}''', 'text': data.caption[i][0]} for i in range(len(data))]
+  jobs = [(data.coco_url[i], f'{args.data_path_coco}/' + lines[i]['img']) for i in range(len(data))]
+  failed = download_images(
+      jobs,
+      n_workers=getattr(args, 'download_workers', 16),
+      manifest_path=f'{args.data_path_coco}/download_failures.jsonl',
+  )
 
+  # Split on the full, id-sorted list so failed downloads do not shift the splits.
+  lines = [line if i not in failed else None for i, line in enumerate(lines)]
   lines_train = lines[:int(len(lines)*args.train_perc)]
   lines_val = lines[int(len(lines)*args.train_perc):int(len(lines)*args.train_perc)+int(len(lines)*args.val_perc)]
   lines_test = lines[int(len(lines)*args.train_perc)+int(len(lines)*args.val_perc):]
+  lines_train = [line for line in lines_train if line is not None]
+  lines_val = [line for line in lines_val if line is not None]
+  lines_test = [line for line in lines_test if line is not None]
 
   with open(f'{args.data_path_coco}/train.jsonl', 'w') as f:
       for item in lines_train:
@@ -81,61 +123,92 @@ def write_formated_data_coco(args, captions, instances):
       for item in lines_test:
           f.write(json.dumps(item) + "\n")
 
-def write_formated_data_mmimdb(args):
-
-  id_list = []
-  for file in sorted(os.listdir(f'{args.data_path_mmimdb}/dataset')):
-    id_list.append(file.split('.')[0])
-  id_list = list(set(id_list))
-  len_id_list = len(id_list)
-
-  id_list_train = id_list[:int(len_id_list*args.train_perc)]
-  id_list_val = id_list[int(len_id_list*args.train_perc):int(len_id_list*args.train_perc)+int(len_id_list*args.val_perc)]
-  id_list_test = id_list[int(len_id_list*args.train_perc)+int(len_id_list*args.val_perc):]
+def stable_split(idx, args):
+  # Position of the id in [0, 1) from a hash that does not depend on
+  # PYTHONHASHSEED, so the same id always lands in the same split.
+  position = int(hashlib.md5(idx.encode()).hexdigest()[:8], 16) / 2 ** 32
+  if position < args.train_perc:
+    return 'train'
+  if position < args.train_perc + args.val_perc:
+    return 'val'
+  return 'test'
+
+def _read_mmimdb_record(path):
+  idx = os.path.basename(path).split('.')[0]
+  with open(path) as f:
+    data = json.load(f)
+  return idx, {
+      'label': data['genres'],
+      'img': f'dataset/{idx}.jpeg',
+      'text': data['plot'][0]
+  }
+
+def write_formated_data_mmimdb(args, n_workers=None):
+  # One streaming pass: metadata files are parsed in a process pool and every
+  # record is written as soon as it arrives. val/test keep only labels seen
+  # in train, which is known only at the end, so they go through a temporary
+  # file and are filtered in a second streaming pass.
+  dataset_dir = f'{args.data_path_mmimdb}/dataset'
+  paths = sorted(os.path.join(dataset_dir, entry.name) for entry in os.scandir(dataset_dir) if entry.name.endswith('.json'))
 
   train_labels = set()
-  train = []
-  for idx in id_list_train:
-      data = json.load(open(f'{args.data_path_mmimdb}/dataset/{idx}.json'))
-      train.append(
-          {
-              'label': data['genres'],
-              'img': f'dataset/{idx}.jpeg',
-              'text': data['plot'][0]
-          }
-      )
-      for label in data['genres']:
-          train_labels.add(label)
-  with jsonlines.open(f'{args.data_path_mmimdb}/train.jsonl', 'w') as writer:
-    writer.write_all(train)
-
-
-  val = []
-  for idx in id_list_val:
-      data = json.load(open(f'{args.data_path_mmimdb}/dataset/{idx}.json'))
-      label = [label for label in data['genres'] if label in train_labels]
-      if len(label)>0:
-          val.append(
-              {
-                  'label': label,
-                  'img': f'dataset/{idx}.jpeg',
-                  'text': data['plot'][0]
-              }
-          )
-  with jsonlines.open(f'{args.data_path_mmimdb}/val.jsonl', 'w') as writer:
-    writer.write_all(val)
-
-  test = []
-  for idx in id_list_test:
-      data = json.load(open(f'{args.data_path_mmimdb}/dataset/{idx}.json'))
-      label = [label for label in data['genres'] if label in train_labels]
-      if len(label)>0:
-          test.append(
-              {
-                  'label': label,
-                  'img': f'dataset/{idx}.jpeg',
-                  'text': data['plot'][0]
-              }
-          )
-  with jsonlines.open(f'{args.data_path_mmimdb}/test.jsonl', 'w') as writer:
-    writer.write_all(test)
+  writers = {
+      'train': jsonlines.open(f'{args.data_path_mmimdb}/train.jsonl', 'w'),
+      'val': jsonlines.open(f'{args.data_path_mmimdb}/val.jsonl.part', 'w'),
+      'test': jsonlines.open(f'{args.data_path_mmimdb}/test.jsonl.part', 'w'),
+  }
+  with multiprocessing.Pool(n_workers) as pool:
+    for idx, record in tqdm(pool.imap(_read_mmimdb_record, paths, chunksize=64), total=len(paths)):
+      split = stable_split(idx, args)
+      writers[split].write(record)
+      if split == 'train':
+        train_labels.update(record['label'])
+  for writer in writers.values():
+    writer.close()
+
+  for split in ['val', 'test']:
+    part = f'{args.data_path_mmimdb}/{split}.jsonl.part'
+    with jsonlines.open(part) as reader, jsonlines.open(f'{args.data_path_mmimdb}/{split}.jsonl', 'w') as writer:
+      for record in reader:
+        label = [label for label in record['label'] if label in train_labels]
+        if len(label)>0:
+          record['label'] = label
+          writer.write(record)
+    os.remove(part)
+
+def _load_shard_image(args):
+  import torchvision.transforms as transforms
+  path, size = args
+  resize = transforms.Compose([transforms.Resize(256 * size // 224), transforms.CenterCrop(size)])
+  # Fully decoded, as the PIL path of JsonlDataset and inference does: a JPEG
+  # draft decode would give different pixels for large images.
+  image = resize(Image.open(path).convert('RGB'))
+  return np.asarray(image, dtype=np.uint8).transpose(2, 0, 1).tobytes()
+
+def write_image_shard(data_path, size=224, n_workers=None):
+  # Resize/crop every image referenced by the splits once and store them as
+  # contiguous CHW uint8 records in images_<size>.u8, with a JSON index of
+  # byte offsets keyed by the 'img' field of the JSONL files.
+  paths = []
+  for split in ['train', 'val', 'test']:
+    with open(f'{data_path}/{split}.jsonl') as f:
+      for line in f:
+        img = json.loads(line)['img']
+        if img:
+          paths.append(img)
+  paths = list(dict.fromkeys(paths))
+
+  record_size = 3 * size * size
+  shard_file = f'{data_path}/images_{size}.u8'
+  shard = np.memmap(shard_file + '.tmp', dtype=np.uint8, mode='w+', shape=(max(len(paths), 1) * record_size,))
+  jobs = [(os.path.join(data_path, p), size) for p in paths]
+  with multiprocessing.Pool(n_workers) as pool:
+    for i, record in enumerate(tqdm(pool.imap(_load_shard_image, jobs, chunksize=16), total=len(jobs))):
+      shard[i * record_size:(i + 1) * record_size] = np.frombuffer(record, dtype=np.uint8)
+  shard.flush()
+  del shard
+  os.replace(shard_file + '.tmp', shard_file)
+
+  index = {'shape': [3, size, size], 'offsets': {p: i * record_size for i, p in enumerate(paths)}}
+  with open(f'{data_path}/images_{size}.json', 'w') as f:
+    json.dump(index, f)
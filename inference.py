@@ -0,0 +1,138 @@
+
+import json
+import os
+import sys
+from itertools import islice
+
+import torch
+from PIL import Image
+
+import train_functions as tf
+
+
+class Predictor(object):
+    # Turns a trained save directory (args.pt, model_best.pt, thresholds.json)
+    # into label predictions for {'text': ..., 'img': ...} records. Only the
+    # model and the preprocessing are built: no optimizer and no dataloaders.
+    def __init__(self, savedir, device=None, batch_sz=32, checkpoint='model_best.pt'):
+        self.args = torch.load(os.path.join(savedir, 'args.pt'), weights_only=False)
+        self.args.device = torch.device(device or ('cuda' if torch.cuda.is_available() else 'cpu'))
+        self.batch_sz = batch_sz
+        self.labels = self.args.labels
+
+        state = torch.load(os.path.join(savedir, checkpoint), map_location=self.args.device, weights_only=False)
+        self.model = load_model(self.args, state)
+        self.modalities = self.model.modalities
+
+        thresholds_path = os.path.join(savedir, 'thresholds.json')
+        if os.path.exists(thresholds_path):
+            with open(thresholds_path) as f:
+                thresholds = json.load(f)
+            self.thresholds = torch.tensor([thresholds[label] for label in self.labels])
+        elif state.get('thresholds') is not None:
+            self.thresholds = torch.tensor(state['thresholds'])
+        else:
+            self.thresholds = torch.full((len(self.labels),), 0.5)
+
+        self.tokenizer = None
+        if 'text' in self.modalities:
+            from transformers import BertTokenizerFast
+            bert_path = tf.bert_path(self.args.bert_type, tf.weights_cache_dir(self.args))
+            self.tokenizer = BertTokenizerFast.from_pretrained(bert_path, do_lower_case=True)
+
+    def preprocess(self, record, data_dir=''):
+        sentence, segment, image = None, None, None
+        if 'text' in self.modalities:
+            ids = self.tokenizer(
+                record['text'],
+                add_special_tokens=False,
+                truncation=True,
+                max_length=self.args.max_seq_len - 1,
+            )['input_ids']
+            sentence = torch.LongTensor([self.tokenizer.cls_token_id] + ids)
+            segment = torch.zeros(len(sentence))
+        if 'img' in self.modalities:
+            # 'img' is a path relative to data_dir or an open file-like object
+            image = record['img']
+            if isinstance(image, str):
+                image = image_path(data_dir, image)
+            image = Image.open(image).convert('RGB')
+            image = tf.get_model_transforms()(image)
+        return sentence, segment, image, torch.zeros(len(self.labels))
+
+    def predict_batch(self, rows):
+        txt, segment, mask, img, _ = tf.batch_to_device(tf.collate_fn(rows, self.args), self.args.device)
+        with torch.no_grad(), tf.autocast(self.args):
+            out = self.model(txt, mask, segment, img)
+        scores = torch.sigmoid(out.float()).cpu()
+        predicted = scores >= self.thresholds
+        return [
+            {
+                'labels': [l for l, p in zip(self.labels, row_predicted) if p],
+                'scores': dict(zip(self.labels, row_scores)),
+            }
+            for row_scores, row_predicted in zip(scores.tolist(), predicted.tolist())
+        ]
+
+    def predict(self, records, data_dir=''):
+        # Yields one {'labels', 'scores'} dict per input record, in order.
+        records = iter(records)
+        while True:
+            chunk = list(islice(records, self.batch_sz))
+            if not chunk:
+                return
+            yield from self.predict_batch([self.preprocess(r, data_dir) for r in chunk])
+
+
+def image_path(data_dir, path):
+    # Records may come from HTTP clients (serve.py): absolute paths, '..' and
+    # symlinks must not reach files outside data_dir.
+    root = os.path.realpath(data_dir)
+    full = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, full]) != root:
+        raise ValueError('image path outside the data directory: {!r}'.format(path))
+    return full
+
+
+def build_encoders(args, pretrained=False):
+    # Without pretrained the weights are overwritten by the checkpoint, so the
+    # random init is skipped where possible: BERT is loaded from a local copy
+    # when there is one, and the ResNet is left uninitialised.
+    cache_dir = tf.weights_cache_dir(args)
+    bert_model, resnet_model = None, None
+    if args.model_type != 'image':
+        if pretrained or os.path.isdir(tf.bert_path(args.bert_type, cache_dir)):
+            bert_model = tf.load_bert(args.bert_type, cache_dir)
+        else:
+            from transformers import BertConfig, BertModel
+            bert_model = BertModel(BertConfig.from_pretrained(args.bert_type))
+    if args.model_type != 'text':
+        if pretrained:
+            resnet_model = tf.load_resnet(args.resnet_type, cache_dir)
+        else:
+            resnet_model = tf.empty_resnet(args.resnet_type).to_empty(device='cpu')
+    return bert_model, resnet_model
+
+
+def load_model(args, state):
+    args.model_type = state['model_type']
+    # Heads trained on a feature cache, and trainable-only checkpoints, were
+    # saved without their frozen encoder weights, which are the pretrained ones.
+    head_only = getattr(args, 'feature_cache_dir', None) is not None or state.get('trainable_only', False)
+    bert_model, resnet_model = build_encoders(args, pretrained=head_only)
+    model = tf.build_model(args.model_type, args, bert_model, resnet_model)
+    model.load_state_dict(state['state_dict'], strict=not head_only)
+    return model.to(args.device).eval()
+
+
+def predict_file(savedir, input_path, output_path, device=None, batch_sz=32):
+    predictor = Predictor(savedir, device=device, batch_sz=batch_sz)
+    with open(input_path) as f_in, open(output_path, 'w') as f_out:
+        records = (json.loads(line) for line in f_in)
+        for prediction in predictor.predict(records, data_dir=os.path.dirname(input_path)):
+            f_out.write(json.dumps(prediction) + '\n')
+
+
+if __name__ == '__main__':
+    # python inference.py <savedir> <input.jsonl> <output.jsonl>
+    predict_file(*sys.argv[1:4])
@@ -0,0 +1,152 @@
+
+import argparse
+import base64
+import io
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import torch
+
+from inference import Predictor
+
+
+class MicroBatcher(object):
+    # Requests are preprocessed (tokenized / decoded) on a worker pool as soon
+    # as they arrive. A single model thread takes the waiting requests, keeps
+    # collecting until max_batch_size requests or max_wait_ms have passed,
+    # and runs them through the model as one batch.
+    def __init__(self, predictor, max_batch_size=16, max_wait_ms=5, n_workers=4, data_dir=''):
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.data_dir = data_dir
+        self.pool = ThreadPoolExecutor(n_workers)
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, record):
+        result = Future()
+        row = self.pool.submit(self.predictor.preprocess, record, self.data_dir)
+        self.queue.put((row, result))
+        return result
+
+    def next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+                continue
+            except queue.Empty:
+                pass
+            # A lone request is not held back waiting for company; the wait
+            # only applies when requests are arriving concurrently.
+            timeout = deadline - time.monotonic()
+            if len(batch) == 1 or timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            rows, results = [], []
+            for row, result in batch:
+                try:
+                    rows.append(row.result())
+                    results.append(result)
+                except Exception as e:
+                    result.set_exception(e)
+            if not rows:
+                continue
+            try:
+                for result, prediction in zip(results, self.predictor.predict_batch(rows)):
+                    result.set_result(prediction)
+            except Exception as e:
+                for result in results:
+                    result.set_exception(e)
+
+
+def make_handler(batcher, timeout=30):
+    class Handler(BaseHTTPRequestHandler):
+        # POST /predict with {"text": ..., "img": <path under --data-dir>} or
+        # {"text": ..., "img_base64": ...}, or a list of such records.
+        def do_POST(self):
+            if self.path != '/predict':
+                return self.reply(404, {'error': 'not found'})
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                records = body if isinstance(body, list) else [body]
+                for record in records:
+                    if 'img_base64' in record:
+                        record['img'] = io.BytesIO(base64.b64decode(record.pop('img_base64')))
+                futures = [batcher.submit(record) for record in records]
+                predictions = [f.result(timeout=timeout) for f in futures]
+            except TimeoutError:
+                # checked first: it is an OSError on Python 3.11+
+                return self.reply(504, {'error': 'timed out'})
+            except OSError:
+                # unreadable images: the error would show server paths
+                return self.reply(400, {'error': 'image could not be read'})
+            except Exception as e:
+                return self.reply(400, {'error': repr(e)})
+            self.reply(200, predictions if isinstance(body, list) else predictions[0])
+
+        def do_GET(self):
+            if self.path == '/health':
+                return self.reply(200, {'status': 'ok'})
+            self.reply(404, {'error': 'not found'})
+
+        def reply(self, code, payload):
+            data = json.dumps(payload).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+
+def make_server(savedir, host='127.0.0.1', port=8000, device=None, max_batch_size=16,
+                max_wait_ms=5, n_workers=4, data_dir=''):
+    predictor = Predictor(savedir, device=device)
+    batcher = MicroBatcher(predictor, max_batch_size, max_wait_ms, n_workers, data_dir)
+    return Server((host, port), make_handler(batcher))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('savedir')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--device', default=None)
+    parser.add_argument('--max-batch-size', type=int, default=16)
+    parser.add_argument('--max-wait-ms', type=float, default=5)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--data-dir', default='')
+    opts = parser.parse_args()
+
+    if opts.threads:
+        torch.set_num_threads(opts.threads)
+    server = make_server(opts.savedir, opts.host, opts.port, opts.device, opts.max_batch_size,
+                         opts.max_wait_ms, opts.workers, opts.data_dir)
+    print('Serving on http://{}:{}'.format(opts.host, server.server_address[1]))
+    server.serve_forever()
@@ -1,30 +1,36 @@
 
 import json
-import jsonlines
 import numpy as np
 import os
 from PIL import Image
 Image.MAX_IMAGE_PIXELS = None
+import contextlib
+import copy
 import functools
+import itertools
+import random
 from collections import Counter
 from argparse import Namespace
-from transformers import BertTokenizer, BertModel
-from tqdm.notebook import tqdm
-import re
-import pandas as pd
+from tqdm.auto import tqdm
 import torch
-import torchvision
 import torch.nn as nn
+import torch.distributed as dist
+import torch.utils.checkpoint
 import torch.optim as optim
-import torchvision.transforms as transforms
 from torch.utils.data import Dataset
 from torch.utils.data import DataLoader
+from torch.utils.data import Sampler
+from torch.utils.data import RandomSampler
+from torch.utils.data.distributed import DistributedSampler
 
 import shutil
-from sklearn.metrics import f1_score
-from sklearn.metrics import precision_recall_curve
-import matplotlib.pyplot as plt
-import requests
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import resource
+import time
+
+# transformers, torchvision, sklearn and matplotlib take seconds to import and
+# each is needed on only some paths, so they are imported where they are used.
 
 class Vocab(object):
     def __init__(self, emptyInit=False):
@@ -48,21 +54,149 @@ class Vocab(object):
             cnt += 1
         self.vocab_sz = len(self.itos)
 
-model_transforms = transforms.Compose(
-    [
-        transforms.Resize(256),
-        transforms.CenterCrop(224),
-        transforms.ToTensor(),
-        transforms.Normalize(
-            mean=[0.46777044, 0.44531429, 0.40661017],
-            std=[0.12221994, 0.12145835, 0.14380469],
-        ),
-    ]
-)
+IMG_MEAN = [0.46777044, 0.44531429, 0.40661017]
+IMG_STD = [0.12221994, 0.12145835, 0.14380469]
+
+@functools.lru_cache(maxsize=None)
+def get_model_transforms():
+  import torchvision.transforms as transforms
+  return transforms.Compose(
+      [
+          transforms.Resize(256),
+          transforms.CenterCrop(224),
+          transforms.ToTensor(),
+          transforms.Normalize(
+              mean=IMG_MEAN,
+              std=IMG_STD,
+          ),
+      ]
+  )
+
+def __getattr__(name):
+  # model_transforms is built on first use
+  if name == 'model_transforms':
+    return get_model_transforms()
+  raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+def file_sha1(path):
+  sha = hashlib.sha1()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(1 << 20), b''):
+      sha.update(chunk)
+  return sha.hexdigest()
+
+class TokenStore(object):
+    # Token ids of a whole split as one flat int32 array plus int64 offsets,
+    # already prefixed with [CLS] and truncated to max_seq_len.
+    def __init__(self, ids_path, offsets_path):
+        self.ids_path = ids_path
+        self.offsets = np.load(offsets_path)
+        self.ids = None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if self.ids is None:
+            self.ids = np.load(self.ids_path, mmap_mode='r')
+        return torch.from_numpy(self.ids[self.offsets[index]:self.offsets[index + 1]].astype(np.int64))
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+def build_token_store(texts, tokenizer, max_seq_len, ids_path, offsets_path, chunk_size=1024):
+  offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+  chunks = []
+  for start in range(0, len(texts), chunk_size):
+    encoded = tokenizer(
+        texts[start:start + chunk_size],
+        add_special_tokens=False,
+        truncation=True,
+        max_length=max_seq_len - 1,
+    )['input_ids']
+    for i, ids in enumerate(encoded):
+      offsets[start + i + 1] = len(ids) + 1
+      chunks.append([tokenizer.cls_token_id] + ids)
+  np.cumsum(offsets, out=offsets)
+  ids = np.fromiter((i for ids in chunks for i in ids), dtype=np.int32, count=int(offsets[-1]))
+  np.save(ids_path + '.tmp.npy', ids)
+  np.save(offsets_path + '.tmp.npy', offsets)
+  os.replace(ids_path + '.tmp.npy', ids_path)
+  os.replace(offsets_path + '.tmp.npy', offsets_path)
+
+def get_token_store(dataset, data_file, args):
+  # Cached per bert_type, max_seq_len and split contents under args.token_cache_dir.
+  os.makedirs(args.token_cache_dir, exist_ok=True)
+  key = hashlib.sha1(json.dumps([args.bert_type, args.max_seq_len, file_sha1(data_file)]).encode()).hexdigest()[:16]
+  name = os.path.splitext(os.path.basename(data_file))[0]
+  ids_path = os.path.join(args.token_cache_dir, '{}-{}.ids.npy'.format(name, key))
+  offsets_path = os.path.join(args.token_cache_dir, '{}-{}.offsets.npy'.format(name, key))
+  if not (os.path.exists(ids_path) and os.path.exists(offsets_path)):
+    from transformers import BertTokenizerFast
+    tokenizer = BertTokenizerFast.from_pretrained(bert_path(args.bert_type, weights_cache_dir(args)), do_lower_case=True)
+    build_token_store(list(dataset.texts()), tokenizer, args.max_seq_len, ids_path, offsets_path)
+  return TokenStore(ids_path, offsets_path)
+
+class JsonlIndex(object):
+    # Built in one pass over a split: the byte offset of every record, its
+    # label ids as a CSR array (label_offsets, label_ids) and its image path in
+    # a numpy bytes table. A few flat arrays instead of a dict per record, so
+    # forked DataLoader workers keep sharing their pages. Without label_to_id
+    # the labels get ids in order of first appearance.
+    def __init__(self, data_path, label_to_id=None):
+        self.data_path = data_path
+        self.label_to_id = {} if label_to_id is None else label_to_id
+        offsets, label_offsets, label_ids, imgs = [], [0], [], []
+        pos = 0
+        with open(data_path, 'rb') as f:
+            for line in f:
+                if line.strip():
+                    row = json.loads(line)
+                    labels = row['label'] if type(row['label']) == list else [row['label']]
+                    if label_to_id is None:
+                        for l in labels:
+                            self.label_to_id.setdefault(l, len(self.label_to_id))
+                    label_ids.extend(self.label_to_id[l] for l in labels)
+                    label_offsets.append(len(label_ids))
+                    imgs.append((row.get('img') or '').encode())
+                    offsets.append(pos)
+                pos += len(line)
+        offsets.append(pos)
+        self.offsets = np.array(offsets, dtype=np.int64)
+        self.label_offsets = np.array(label_offsets, dtype=np.int64)
+        self.label_ids = np.array(label_ids, dtype=np.int64)
+        self.imgs = np.array(imgs, dtype=bytes)
+        self.file = None
+
+    def __len__(self):
+        return len(self.imgs)
+
+    def record(self, index):
+        if self.file is None:
+            self.file = np.memmap(self.data_path, dtype=np.uint8, mode='r')
+        return json.loads(self.file[self.offsets[index]:self.offsets[index + 1]].tobytes())
+
+    def labels(self, index):
+        return self.label_ids[self.label_offsets[index]:self.label_offsets[index + 1]]
+
+    def img(self, index):
+        return self.imgs[index].decode()
+
+    def label_counts(self):
+        return np.bincount(self.label_ids, minlength=len(self.label_to_id))
+
+    def texts(self):
+        with open(self.data_path) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)['text']
 
 class JsonlDataset(Dataset):
-    def __init__(self, data_path, tokenizer, transforms, vocab, args):
-        self.data = [json.loads(l) for l in open(data_path)]
+    def __init__(self, data_path, tokenizer, transforms, vocab, args, modalities=('text', 'img'), index=None):
+        # index: a JsonlIndex of data_path, if one was already built
+        if index is None:
+            index = JsonlIndex(data_path, {l: i for i, l in enumerate(args.labels)})
+        self.index = index
         self.data_dir = os.path.dirname(data_path)
         self.tokenizer = tokenizer
         self.args = args
@@ -72,14 +206,23 @@ class JsonlDataset(Dataset):
 
         self.max_seq_len = args.max_seq_len
         self.transforms = transforms
+        self.modalities = modalities
+        self.tokens = None
 
     def __len__(self):
-        return len(self.data)
+        return len(self.index)
+
+    def texts(self):
+        return self.index.texts()
+
+    def load_text(self, index):
+        if self.tokens is not None:
+            sentence = self.tokens[index]
+            return sentence, torch.zeros(len(sentence))
 
-    def __getitem__(self, index):
         sentence = (
             self.text_start_token
-            + self.tokenizer(self.data[index]['text'])[:(self.args.max_seq_len - 1)]
+            + self.tokenizer(self.index.record(index)['text'])[:(self.args.max_seq_len - 1)]
         )
         segment = torch.zeros(len(sentence))
 
@@ -89,54 +232,286 @@ class JsonlDataset(Dataset):
                 for w in sentence
             ]
         )
+        return sentence, segment
 
-        label = torch.zeros(self.n_classes)
-        label[
-            [self.args.labels.index(tgt) for tgt in self.data[index]['label']]
-        ] = 1
+    def load_image(self, index):
+        if self.index.img(index):
+            image = Image.open(os.path.join(self.data_dir, self.index.img(index))).convert('RGB')
 
-        if self.data[index]['img']:
-            image = Image.open(os.path.join(self.data_dir, self.data[index]['img'])).convert('RGB')
+        return self.transforms(image)
 
-        image = self.transforms(image)
+    def load_label(self, index):
+        label = torch.zeros(self.n_classes)
+        label[torch.from_numpy(self.index.labels(index))] = 1
+        return label
+
+    def __getitem__(self, index):
+        sentence, segment, image = None, None, None
+        if 'text' in self.modalities:
+            sentence, segment = self.load_text(index)
+        if 'img' in self.modalities:
+            image = self.load_image(index)
+        label = self.load_label(index)
 
         return sentence, segment, image, label
 
-def collate_fn(batch, args):
-    lens = [len(row[0]) for row in batch]
-    bsz, max_seq_len = len(batch), max(lens)
+class ShardJsonlDataset(JsonlDataset):
+    # Reads images from the uint8 shard written by get_datasets.write_image_shard.
+    # Records are returned as zero-copy CHW uint8 views and normalized per batch
+    # in collate_fn.
+    def __init__(self, data_path, tokenizer, transforms, vocab, args, modalities=('text', 'img'), index=None, size=224):
+        super(ShardJsonlDataset, self).__init__(data_path, tokenizer, transforms, vocab, args, modalities, index)
+        with open(os.path.join(self.data_dir, 'images_{}.json'.format(size))) as f:
+            shard_index = json.load(f)
+        self.shard_file = os.path.join(self.data_dir, 'images_{}.u8'.format(size))
+        self.shape = shard_index['shape']
+        self.offsets = np.array([shard_index['offsets'][self.index.img(i)] for i in range(len(self.index))], dtype=np.int64)
+        self.shard = None
+
+    def load_image(self, index):
+        if self.shard is None:
+            self.shard = np.memmap(self.shard_file, dtype=np.uint8, mode='c')
+        offset = self.offsets[index]
+        record = self.shard[offset:offset + int(np.prod(self.shape))]
+        return torch.from_numpy(record).view(*self.shape)
+
+def normalize_images(img_tensor, out=None):
+    mean = torch.tensor(IMG_MEAN).view(1, 3, 1, 1)
+    std = torch.tensor(IMG_STD).view(1, 3, 1, 1)
+    if out is None:
+        out = img_tensor.float()
+    else:
+        out.copy_(img_tensor)
+    return out.div_(255).sub_(mean).div_(std)
+
+class CollateBuffers(object):
+    # Ring of `n_slots` host buffers (pinned when CUDA is available) that
+    # collate_fn writes batches into instead of allocating new tensors. A slot
+    # is overwritten `n_slots` batches later, so this is only safe when collate
+    # runs in the main process (n_workers=0) and batches are consumed in order.
+    # Pinned slots are copied to the GPU with non_blocking, so a slot is only
+    # reused once the copies queued from it have finished.
+    def __init__(self, n_slots=4, pin_memory=True):
+        self.n_slots = n_slots
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.slots = [{} for _ in range(n_slots)]
+        self.events = [None] * n_slots
+        self.step = 0
+
+    def next_slot(self):
+        i = self.step % self.n_slots
+        if self.pin_memory and self.step > 0:
+            # The previous batch has been handed out and its copies queued by
+            # the time the next one is collated; mark the end of those copies.
+            prev = (self.step - 1) % self.n_slots
+            self.events[prev] = torch.cuda.Event()
+            self.events[prev].record()
+        if self.events[i] is not None:
+            self.events[i].synchronize()
+        self.step += 1
+        return self.slots[i]
+
+    def get(self, slot, name, shape, dtype):
+        numel = int(np.prod(shape))
+        buf = slot.get(name)
+        if buf is None or buf.dtype != dtype or buf.numel() < numel:
+            buf = torch.empty(numel, dtype=dtype, pin_memory=self.pin_memory)
+            slot[name] = buf
+        return buf[:numel].view(*shape)
+
+def collate_fn(batch, args, buffers=None):
+    bsz = len(batch)
+    slot = buffers.next_slot() if buffers is not None else None
+
+    def alloc(name, shape, dtype):
+        if slot is None:
+            return torch.empty(shape, dtype=dtype)
+        return buffers.get(slot, name, shape, dtype)
+
+    tgt_tensor = torch.stack([row[3] for row in batch], out=alloc('tgt', (bsz,) + batch[0][3].shape, batch[0][3].dtype))
+
+    img_tensor = None
+    if batch[0][2] is not None:
+        img_shape = (bsz,) + batch[0][2].shape
+        img_tensor = torch.stack([row[2] for row in batch], out=alloc('img_raw', img_shape, batch[0][2].dtype))
+        if img_tensor.dtype == torch.uint8:
+            img_tensor = normalize_images(img_tensor, out=alloc('img', img_shape, torch.float32))
+
+    if batch[0][0] is None:
+        return None, None, None, img_tensor, tgt_tensor
+
+    # Segments are all zero (single-segment input) and the mask follows from
+    # the lengths, so the whole text side is built without a per-row loop.
+    lens = torch.tensor([len(row[0]) for row in batch])
+    max_seq_len = int(lens.max())
+
+    mask = torch.arange(max_seq_len).unsqueeze(0) < lens.unsqueeze(1)
+    mask_tensor = alloc('mask', (bsz, max_seq_len), torch.long)
+    mask_tensor.copy_(mask)
+
+    text_tensor = alloc('text', (bsz, max_seq_len), torch.long).zero_()
+    text_tensor[mask] = torch.cat([row[0] for row in batch]).long()
+
+    segment_tensor = alloc('segment', (bsz, max_seq_len), torch.long).zero_()
 
-    mask_tensor = torch.zeros(bsz, max_seq_len).long()
-    text_tensor = torch.zeros(bsz, max_seq_len).long()
-    segment_tensor = torch.zeros(bsz, max_seq_len).long()
+    return text_tensor, segment_tensor, mask_tensor, img_tensor, tgt_tensor
 
-    img_tensor = torch.stack([row[2] for row in batch])
+class BucketBatchSampler(Sampler):
+    # Shuffles the indices every epoch, sorts them by length inside pools of
+    # `pool_batches` batches and cuts each pool into batches, so a batch holds
+    # similar lengths while the epoch order stays random. With `max_tokens` a
+    # batch grows until its padded size (rows x longest row) would exceed the
+    # budget, instead of having a fixed batch_size. With `num_replicas` every
+    # rank builds the same batches from the shared seed and keeps every
+    # num_replicas-th one.
+    def __init__(self, lengths, batch_size, max_tokens=None, pool_batches=50, shuffle=True, drop_last=False, seed=0, num_replicas=1, rank=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.pool_batches = pool_batches
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.batches = None
+
+    def make_batches(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        order = rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        pool_size = self.batch_size * self.pool_batches
+
+        batches = []
+        for start in range(0, len(order), pool_size):
+            pool = order[start:start + pool_size]
+            pool = pool[np.argsort(self.lengths[pool], kind='stable')]
+            if self.max_tokens is None:
+                batches.extend(pool[i:i + self.batch_size] for i in range(0, len(pool), self.batch_size))
+                continue
+            batch, longest = [], 0
+            for index in pool:
+                longest_with = max(longest, self.lengths[index])
+                if batch and longest_with * (len(batch) + 1) > self.max_tokens:
+                    batches.append(batch)
+                    batch, longest_with = [], self.lengths[index]
+                batch.append(index)
+                longest = longest_with
+            if batch:
+                batches.append(batch)
+
+        if self.drop_last and self.max_tokens is None:
+            batches = [b for b in batches if len(b) == self.batch_size]
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        if self.num_replicas > 1:
+            batches = batches[:len(batches) - len(batches) % self.num_replicas][self.rank::self.num_replicas]
+        return [[int(i) for i in b] for b in batches]
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.batches = None
+
+    def __iter__(self):
+        if self.batches is None:
+            self.batches = self.make_batches()
+        batches, self.batches = self.batches, None
+        self.epoch += 1
+        yield from batches
 
-    tgt_tensor = torch.stack([row[3] for row in batch])
+    def __len__(self):
+        if self.batches is None:
+            self.batches = self.make_batches()
+        return len(self.batches)
+
+def is_distributed():
+  return dist.is_available() and dist.is_initialized()
+
+def is_main_process():
+  return not is_distributed() or dist.get_rank() == 0
+
+@contextlib.contextmanager
+def main_process_first():
+  # Rank 0 runs the block first (e.g. writes a cache), the other ranks run it
+  # after and find the files in place.
+  if not is_main_process():
+    dist.barrier()
+  yield
+  if is_distributed() and is_main_process():
+    dist.barrier()
+
+def distributed_sampler(dataset, shuffle):
+  if not is_distributed():
+    return None
+  return DistributedSampler(dataset, shuffle=shuffle, drop_last=shuffle)
+
+class ResumableSampler(Sampler):
+    # Wraps the train sampler, or batch sampler, so that an epoch's order only
+    # depends on seed + epoch and the epoch can start after `start` batches:
+    # resuming replays the interrupted epoch's order and skips what was done.
+    def __init__(self, sampler, seed=0, batch_size=1):
+        self.sampler = sampler
+        self.seed = seed
+        self.batch_size = batch_size
+        self.start = 0
+
+    def set_epoch(self, epoch, start_batch=0):
+        self.start = start_batch * self.batch_size
+        if hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(epoch)
+        else:
+            self.sampler.generator.manual_seed(self.seed + epoch)
 
-    for i_batch, (input_row, length) in enumerate(zip(batch, lens)):
-        tokens, segment = input_row[:2]
-        text_tensor[i_batch, :length] = tokens
-        segment_tensor[i_batch, :length] = segment
-        mask_tensor[i_batch, :length] = 1
+    def __iter__(self):
+        start, self.start = self.start, 0
+        return itertools.islice(iter(self.sampler), start, None)
 
-    return text_tensor, segment_tensor, mask_tensor, img_tensor, tgt_tensor
+    def __len__(self):
+        return len(self.sampler)
+
+def train_sampler(dataset, args):
+  sampler = distributed_sampler(dataset, True)
+  if sampler is None:
+    sampler = RandomSampler(dataset, generator=torch.Generator())
+  return ResumableSampler(sampler, getattr(args, 'seed', 0), args.batch_sz)
+
+def resumable_sampler(loader):
+  for sampler in (loader.batch_sampler, loader.sampler):
+    if isinstance(sampler, ResumableSampler):
+      return sampler
+  return None
+
+def get_rng_state():
+  return {
+      'python': random.getstate(),
+      'numpy': np.random.get_state(),
+      'torch': torch.get_rng_state(),
+      'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+  }
+
+def set_rng_state(state):
+  random.setstate(state['python'])
+  np.random.set_state(state['numpy'])
+  torch.set_rng_state(state['torch'].cpu())
+  if state['cuda'] is not None and torch.cuda.is_available():
+    torch.cuda.set_rng_state_all([s.cpu() for s in state['cuda']])
+
+def text_lengths(dataset, args):
+  if dataset.tokens is not None:
+    return dataset.tokens.lengths()
+  # Without a token cache use the word count as a cheap proxy for the length;
+  # it undercounts wordpieces, which is fine for bucketing only.
+  return np.array([min(len(text.split()) + 1, args.max_seq_len) for text in dataset.texts()])
 
 def get_dataloader(data_path, args):
 
-  label_freqs = Counter()
-  data_labels = [json.loads(line)['label'] for line in open(os.path.join(data_path, 'train.jsonl'))]
+  # Labels are numbered in order of first appearance in train.jsonl.
+  train_index = JsonlIndex(os.path.join(data_path, 'train.jsonl'))
+  args.labels = list(train_index.label_to_id)
+  args.label_freqs = Counter(dict(zip(args.labels, train_index.label_counts().tolist())))
 
-  if type(data_labels[0]) == list:
-      for label_row in data_labels:
-          label_freqs.update(label_row)
-  else:
-      label_freqs.update(data_labels)
-
-  args.labels = list(label_freqs.keys())
-  args.label_freqs = label_freqs
-
-  tokenizer = BertTokenizer.from_pretrained(args.bert_type, do_lower_case=True)
+  from transformers import BertTokenizer
+  tokenizer = BertTokenizer.from_pretrained(bert_path(args.bert_type, weights_cache_dir(args)), do_lower_case=True)
   vocab = Vocab()
   vocab.stoi = tokenizer.vocab
   vocab.itos = tokenizer.ids_to_tokens
@@ -146,384 +521,1141 @@ def get_dataloader(data_path, args):
   args.n_classes = len(args.labels)
   tokenizer = tokenizer.tokenize
 
-  model_transforms = transforms.Compose(
-      [
-          transforms.Resize(256),
-          transforms.CenterCrop(224),
-          transforms.ToTensor(),
-          transforms.Normalize(
-              mean=[0.46777044, 0.44531429, 0.40661017],
-              std=[0.12221994, 0.12145835, 0.14380469],
-          ),
-      ]
-  )
+  model_transforms = get_model_transforms()
 
-  collate = functools.partial(collate_fn, args=args)
+  # args.collate_buffers: reuse that many pinned host buffers between batches
+  # (only when collate runs in the main process)
+  buffers = None
+  if getattr(args, 'collate_buffers', 0) and args.n_workers == 0:
+    buffers = CollateBuffers(args.collate_buffers)
+  collate = functools.partial(collate_fn, args=args, buffers=buffers)
+  pin_memory = getattr(args, 'device', None) is not None and args.device.type == 'cuda' and buffers is None
 
-  train = JsonlDataset(os.path.join(data_path, 'train.jsonl'),tokenizer,model_transforms,vocab,args,)
-  train_loader = DataLoader(train,batch_size=args.batch_sz,shuffle=True,num_workers=args.n_workers,collate_fn=collate,drop_last=True,)
-  args.train_data_len = len(train)
+  # args.image_shard: read preprocessed images from get_datasets.write_image_shard
+  dataset_cls = ShardJsonlDataset if getattr(args, 'image_shard', False) else JsonlDataset
 
-  val = JsonlDataset(os.path.join(data_path, 'val.jsonl'),tokenizer,model_transforms,vocab,args,)
-  val_loader = DataLoader(val,batch_size=args.batch_sz,shuffle=False,num_workers=args.n_workers,collate_fn=collate,)
+  train = dataset_cls(os.path.join(data_path, 'train.jsonl'),tokenizer,model_transforms,vocab,args,index=train_index,)
+  args.train_data_len = len(train)
 
-  test = JsonlDataset(os.path.join(data_path, 'test.jsonl'),tokenizer,model_transforms,vocab,args,)
-  test_loader = DataLoader(test,batch_size=args.batch_sz,shuffle=False,num_workers=args.n_workers,collate_fn=collate,)
+  # Under torch.distributed every rank loads its own shard of each split;
+  # model_eval gathers the val/test shards back together.
+  val = dataset_cls(os.path.join(data_path, 'val.jsonl'),tokenizer,model_transforms,vocab,args,)
+  val_loader = DataLoader(val,batch_size=args.batch_sz,shuffle=False,sampler=distributed_sampler(val, False),num_workers=args.n_workers,collate_fn=collate,pin_memory=pin_memory,)
+
+  test = dataset_cls(os.path.join(data_path, 'test.jsonl'),tokenizer,model_transforms,vocab,args,)
+  test_loader = DataLoader(test,batch_size=args.batch_sz,shuffle=False,sampler=distributed_sampler(test, False),num_workers=args.n_workers,collate_fn=collate,pin_memory=pin_memory,)
+
+  # args.token_cache_dir: tokenize each split once and slice ids from the cache.
+  # A token budget needs the wordpiece lengths, so it defaults to one under data_path.
+  if getattr(args, 'max_tokens_per_batch', None) and getattr(args, 'token_cache_dir', None) is None:
+    args.token_cache_dir = os.path.join(data_path, 'token_cache')
+  if getattr(args, 'token_cache_dir', None) is not None:
+    with main_process_first():
+      for split, dataset in (('train', train), ('val', val), ('test', test)):
+        dataset.tokens = get_token_store(dataset, os.path.join(data_path, split + '.jsonl'), args)
+
+  # args.bucket_batches: group similar text lengths; args.max_tokens_per_batch
+  # replaces the fixed batch_sz with a padded-token budget
+  if getattr(args, 'bucket_batches', False) or getattr(args, 'max_tokens_per_batch', None):
+    replicas = dict(num_replicas=dist.get_world_size(), rank=dist.get_rank()) if is_distributed() else {}
+    sampler = BucketBatchSampler(text_lengths(train, args), args.batch_sz, max_tokens=getattr(args, 'max_tokens_per_batch', None), drop_last=True, seed=getattr(args, 'seed', 0), **replicas)
+    train_loader = DataLoader(train,batch_sampler=ResumableSampler(sampler),num_workers=args.n_workers,collate_fn=collate,pin_memory=pin_memory,)
+  else:
+    train_loader = DataLoader(train,batch_size=args.batch_sz,sampler=train_sampler(train, args),num_workers=args.n_workers,collate_fn=collate,pin_memory=pin_memory,drop_last=True,)
 
   return train_loader, val_loader, test_loader, args
 
 def find_threshold_f1(trues, logits, eps=1e-9):
+    from sklearn.metrics import precision_recall_curve
     precision, recall, thresholds = precision_recall_curve(trues, logits)
     f1_scores = 2 * precision * recall / (precision + recall + eps)
     threshold = float(thresholds[np.argmax(f1_scores)])
     return np.max(f1_scores), threshold
 
-def save_checkpoint(state, is_best, checkpoint_path, filename='checkpoint.pt'):
+def find_thresholds_f1(trues, logits, eps=1e-9):
+    # Column-wise find_threshold_f1 for a [n_samples, n_classes] matrix: one
+    # sort of all columns, cumulative TP/FP counts, and the F1 at every
+    # distinct score. Ties between equal F1 go to the lowest threshold, as
+    # with np.argmax over precision_recall_curve's ascending thresholds.
+    # Columns are transposed so every sort and scan runs on contiguous memory.
+    logits = np.ascontiguousarray(logits.T)
+    trues = np.ascontiguousarray(trues.T)
+    n = logits.shape[1]
+    # Order inside a run of equal scores does not matter, since only the end
+    # of each run is a candidate threshold, so an unstable sort is fine.
+    order = np.argsort(logits, axis=1)[:, ::-1]
+    scores = np.take_along_axis(logits, order, axis=1)
+    tps = np.cumsum(np.take_along_axis(trues, order, axis=1), axis=1, dtype=np.float64)
+    fps = np.arange(1, n + 1, dtype=np.float64) - tps
+
+    precision = tps / (tps + fps)
+    n_pos = tps[:, -1:]
+    recall = np.divide(tps, n_pos, out=np.ones_like(tps), where=n_pos > 0)
+    f1_scores = 2 * precision * recall / (precision + recall + eps)
+
+    # Only the last position of each run of equal scores is a threshold.
+    distinct = np.ones(scores.shape, dtype=bool)
+    distinct[:, :-1] = scores[:, :-1] != scores[:, 1:]
+    f1_scores[~distinct] = -np.inf
+
+    best = n - 1 - np.argmax(f1_scores[:, ::-1], axis=1)
+    rows = np.arange(logits.shape[0])
+    return f1_scores[rows, best], scores[rows, best].astype(np.float64)
+
+# Run-time objects that main() hangs on args; they are rebuilt, not pickled.
+RUNTIME_ARGS = ['train_loader', 'val_loader', 'test_loader', 'optimizer', 'scheduler', 'criterion', 'vocab', 'device']
+
+def save_args(args, path):
+    torch.save(Namespace(**{k: v for k, v in vars(args).items() if k not in RUNTIME_ARGS}), path)
+
+def save_thresholds(labels, thresholds, checkpoint_path):
+    path = os.path.join(checkpoint_path, 'thresholds.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(dict(zip(labels, thresholds)), f, indent=1)
+    os.replace(path + '.tmp', path)
+
+def save_checkpoint(state, is_best, checkpoint_path, filename='checkpoint.pt', labels=None):
+    # Written under a temporary name and renamed, so a crash mid-write never
+    # leaves a truncated file; model_best.pt becomes a hardlink to the new file.
+    # With labels, thresholds.json is written after model_best.pt, so the two
+    # always come from the same epoch.
     filename = os.path.join(checkpoint_path, filename)
-    torch.save(state, filename)
+    torch.save(state, filename + '.tmp')
+    os.replace(filename + '.tmp', filename)
     if is_best:
-        shutil.copyfile(filename, os.path.join(checkpoint_path, 'model_best.pt'))
-
-def load_checkpoint(model, path):
-    best_checkpoint = torch.load(path)
-    model.load_state_dict(best_checkpoint['state_dict'])
+        best = os.path.join(checkpoint_path, 'model_best.pt')
+        if os.path.exists(best + '.tmp'):
+            os.remove(best + '.tmp')
+        try:
+            os.link(filename, best + '.tmp')
+        except OSError:
+            shutil.copyfile(filename, best + '.tmp')
+        os.replace(best + '.tmp', best)
+        if labels is not None and state.get('thresholds') is not None:
+            save_thresholds(labels, state['thresholds'], checkpoint_path)
+
+def cpu_snapshot(obj):
+    # Detached CPU copies of every tensor in a (nested) state dict, so it can
+    # be written while training keeps updating the originals.
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        snapshot = type(obj)((k, cpu_snapshot(v)) for k, v in obj.items())
+        if hasattr(obj, '_metadata'):
+            snapshot._metadata = obj._metadata
+        return snapshot
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(cpu_snapshot(v) for v in obj)
+    return obj
+
+def trainable_state_dict(model, keep=()):
+    # Everything but the frozen parameters not named in keep; buffers are kept.
+    frozen = set(n for n, p in model.named_parameters() if not p.requires_grad and n not in keep)
+    state = model.state_dict()
+    for name in frozen:
+        del state[name]
+    return state
+
+class AsyncCheckpointer(object):
+    # save() takes a CPU snapshot and hands it to a background thread that
+    # runs save_checkpoint, so training only waits for the copy. At most one
+    # snapshot is alive: save() first waits for the previous write.
+    def __init__(self, background=True):
+        self.pool = ThreadPoolExecutor(1) if background else None
+        self.pending = None
+
+    def save(self, state, is_best, checkpoint_path, filename='checkpoint.pt', labels=None):
+        if self.pool is None:
+            return save_checkpoint(state, is_best, checkpoint_path, filename, labels)
+        self.wait()
+        self.pending = self.pool.submit(save_checkpoint, cpu_snapshot(state), is_best, checkpoint_path, filename, labels)
+
+    def wait(self):
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    def close(self):
+        self.wait()
+        if self.pool is not None:
+            self.pool.shutdown()
+
+def make_criterion(args):
+  freqs = [args.label_freqs[l] for l in args.labels]
+  label_weights = (torch.FloatTensor(freqs) / args.train_data_len) ** -1
+  return nn.BCEWithLogitsLoss(pos_weight=label_weights.to(args.device))
+
+def get_device(args):
+  # args.device: 'cuda', 'cpu', ... (default: cuda when available)
+  device = getattr(args, 'device', None)
+  if device is None:
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+  args.device = torch.device(device)
+  return args.device
+
+def init_distributed(args):
+  # args.distributed: one process per rank, started by torchrun or
+  # run_distributed(); args.dist_backend defaults to gloo, which runs on CPU.
+  if not dist.is_initialized():
+    dist.init_process_group(backend=getattr(args, 'dist_backend', 'gloo'))
+  if args.device.type == 'cuda':
+    args.device = torch.device('cuda', int(os.environ.get('LOCAL_RANK', 0)))
+    torch.cuda.set_device(args.device)
+  return dist.get_rank(), dist.get_world_size()
+
+def _distributed_worker(rank, world_size, port, fn, fn_args):
+  os.environ.update(MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port), RANK=str(rank), WORLD_SIZE=str(world_size), LOCAL_RANK=str(rank))
+  torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+  try:
+    fn(*fn_args)
+  finally:
+    dist.destroy_process_group()
+
+def run_distributed(fn, world_size, *fn_args, port=29500):
+  # run_distributed(main, 2, args, dataset_path) with args.distributed = True
+  torch.multiprocessing.spawn(_distributed_worker, args=(world_size, port, fn, fn_args), nprocs=world_size)
+
+def batch_to_device(batch, device):
+    return [t.to(device, non_blocking=True) if t is not None else None for t in batch]
+
+def autocast(args):
+    # args.amp: bfloat16 autocast on CPU, float16 on GPU
+    device_type = args.device.type
+    dtype = torch.float16 if device_type == 'cuda' else torch.bfloat16
+    return torch.autocast(device_type=device_type, dtype=dtype, enabled=getattr(args, 'amp', False))
+
+def load_checkpoint(model, path, device='cpu'):
+    best_checkpoint = torch.load(path, map_location=device, weights_only=False)
+    # A trainable-only checkpoint leaves the frozen weights as the model has them.
+    model.load_state_dict(best_checkpoint['state_dict'], strict=not best_checkpoint.get('trainable_only', False))
+
+def gather_shards(shard, n_samples):
+  # DistributedSampler deals sample i to rank i % world_size and pads the last
+  # round with repeats: interleave the ranks' shards and drop the padding.
+  shards = [torch.empty_like(shard) for _ in range(dist.get_world_size())]
+  dist.all_gather(shards, shard)
+  return torch.stack(shards, 1).reshape(-1, *shard.shape[1:])[:n_samples]
 
 def model_eval(i_epoch, data, model, args):
+    # Loss, predictions and targets stay on the device in preallocated
+    # tensors and are copied to the host once, after the last batch.
+    n_samples = len(data.sampler)
+    preds = torch.empty(n_samples, args.n_classes, device=args.device)
+    tgts = torch.empty(n_samples, args.n_classes, device=args.device)
+    loss_sum = torch.zeros((), device=args.device)
+    n_batches, pos = 0, 0
     with torch.no_grad():
-        losses, preds, tgts = [], [], []
         for batch in data:
-            txt, segment, mask, img, tgt = batch
+            txt, segment, mask, img, tgt = batch_to_device(batch, args.device)
 
-            txt, img = txt.cuda(), img.cuda()
-            mask, segment = mask.cuda(), segment.cuda()
-            tgt = tgt.cuda()
-
-            out = model(txt, mask, segment, img)
+            with autocast(args):
+                out = model(txt, mask, segment, img)
+            out = out.float()
             loss = args.criterion(out, tgt)
-            losses.append(loss.item())
-
-            pred = torch.sigmoid(out).cpu().detach().numpy()
+            loss_sum += loss
+            n_batches += 1
 
-            preds.append(pred.tolist())
-            tgt = tgt.cpu().detach().numpy().tolist()
-            tgts.extend(tgt)
+            preds[pos:pos + len(out)] = torch.sigmoid(out)
+            tgts[pos:pos + len(out)] = tgt
+            pos += len(out)
 
-    metrics = {'loss': np.mean(losses)}
-    tgts = np.vstack(tgts)
-    preds = np.vstack(preds)
+    preds, tgts = preds[:pos], tgts[:pos]
+    n_batches = torch.tensor(float(n_batches), device=args.device)
+    if is_distributed():
+        dist.all_reduce(loss_sum)
+        dist.all_reduce(n_batches)
+        preds = gather_shards(preds, len(data.dataset))
+        tgts = gather_shards(tgts, len(data.dataset))
 
-    f1_scores_list = []
-    tresholds_list = []
+    metrics = {'loss': (loss_sum / n_batches).item()}
+    tgts = tgts.cpu().numpy()
+    preds = preds.cpu().numpy()
 
-    for i in range(tgts.shape[1]):
-      f1, treshold = find_threshold_f1(tgts[:,i], preds[:,i], eps=1e-9)
-      f1_scores_list.append(f1)
-      tresholds_list.append(treshold)
+    f1_scores, thresholds = find_thresholds_f1(tgts, preds, eps=1e-9)
 
-    metrics['macro_f1'] = sum(f1_scores_list) / len(f1_scores_list)
+    metrics['macro_f1'] = float(f1_scores.mean())
+    metrics['thresholds'] = thresholds.tolist()
 
     return metrics
 
+# Model parts timed through forward hooks, reported as forward.<stage>.
+MODULE_STAGES = {
+    'txtenc': 'bert',
+    'imgenc': 'resnet',
+    'clf': 'clf',
+    'txtclf': 'clf',
+    'imgclf': 'clf',
+}
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+class Telemetry(object):
+    # Times the phases of a training step (data_wait, h2d, forward, backward,
+    # optimizer_step) and the forward passes of the encoders and clf heads,
+    # and appends one JSON line per `every` steps to `path` with throughput,
+    # the data-wait share of the wall time, the average ms per stage and the
+    # peak RSS. On GPU each stage synchronizes first so that kernels are
+    # counted in the stage that launched them. `profile_steps=(start, n)`
+    # also records a torch.profiler trace of n steps after step `start` to
+    # `trace_path`. A disabled Telemetry does nothing.
+    def __init__(self, model=None, path=None, every=50, device=None, profile_steps=None, trace_path=None, enabled=True):
+        self.enabled = enabled
+        self.path = path
+        self.every = every
+        self.sync = device is not None and torch.device(device).type == 'cuda'
+        self.handles = []
+        self.profiler = None
+        if not enabled:
+            return
+        self.reset()
+        if model is not None:
+            self.attach(model)
+        if profile_steps is not None:
+            start, n_steps = profile_steps
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.sync:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(
+                activities=activities,
+                schedule=torch.profiler.schedule(wait=max(start - 1, 0), warmup=min(start, 1), active=n_steps, repeat=1),
+                on_trace_ready=lambda p: p.export_chrome_trace(trace_path),
+                record_shapes=True,
+            )
+            self.profiler.start()
+
+    def reset(self):
+        self.stages = {}
+        self.n_steps = 0
+        self.n_samples = 0
+        self.n_tokens = 0
+        self.window_start = time.perf_counter()
+
+    def synchronize(self):
+        if self.sync:
+            torch.cuda.synchronize()
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def _stage(self, name):
+        self.synchronize()
+        start = time.perf_counter()
+        with torch.profiler.record_function(name):
+            yield
+        self.synchronize()
+        self.add(name, time.perf_counter() - start)
+
+    def stage(self, name):
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self._stage(name)
+
+    def attach(self, model):
+        for attr, name in MODULE_STAGES.items():
+            module = getattr(model, attr, None)
+            if module is None:
+                continue
+            # a ModuleList clf is applied layer by layer, never called itself
+            first, last = (module[0], module[-1]) if isinstance(module, nn.ModuleList) else (module, module)
+            stage = 'forward.' + name
+            self.handles.append(first.register_forward_pre_hook(
+                lambda m, inputs, stage=stage: self._enter(m, stage)))
+            self.handles.append(last.register_forward_hook(
+                lambda m, inputs, output, stage=stage: self._exit(m, stage)))
+
+    # The hooks stay attached through evaluation; only training forwards count.
+    def _enter(self, module, stage):
+        if not module.training:
+            return
+        self.synchronize()
+        self.stages.setdefault('_start', {})[stage] = time.perf_counter()
+
+    def _exit(self, module, stage):
+        if not module.training:
+            return
+        self.synchronize()
+        self.add(stage, time.perf_counter() - self.stages['_start'].pop(stage))
+
+    def wrap_loader(self, batches):
+        # Time spent waiting for the next batch.
+        if not self.enabled:
+            return batches
+        return self._timed(batches)
+
+    def _timed(self, batches):
+        batches = iter(batches)
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = next(batches)
+            except StopIteration:
+                return
+            self.add('data_wait', time.perf_counter() - start)
+            yield batch
+
+    def step(self, epoch, global_step, n_samples, n_tokens=0):
+        if not self.enabled:
+            return
+        self.n_steps += 1
+        self.n_samples += n_samples
+        self.n_tokens += n_tokens
+        if self.profiler is not None:
+            self.profiler.step()
+        if self.n_steps >= self.every:
+            self.flush(epoch, global_step)
+
+    def flush(self, epoch, global_step):
+        if not self.enabled or self.n_steps == 0:
+            return
+        wall = time.perf_counter() - self.window_start
+        stages = {k: v for k, v in self.stages.items() if k != '_start'}
+        record = {
+            'epoch': epoch,
+            'step': global_step,
+            'steps': self.n_steps,
+            'samples_per_s': self.n_samples / wall,
+            'tokens_per_s': self.n_tokens / wall,
+            'data_wait_pct': 100 * stages.get('data_wait', 0.0) / wall,
+            'stage_ms': {k: 1000 * v / self.n_steps for k, v in sorted(stages.items())},
+            'peak_rss_mb': peak_rss_mb(),
+        }
+        if torch.cuda.is_available() and self.sync:
+            record['peak_cuda_mb'] = torch.cuda.max_memory_allocated() / 2 ** 20
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+        self.reset()
+
+    def close(self, epoch=None, global_step=None):
+        if not self.enabled:
+            return
+        self.flush(epoch, global_step)
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler = None
+
 def model_train(model, args, savedir):
 
   optimizer = args.optimizer
   scheduler = args.scheduler
   criterion = args.criterion
+  # Loss scaling is only needed for float16 autocast on GPU.
+  scaler = torch.cuda.amp.GradScaler(enabled=getattr(args, 'amp', False) and args.device.type == 'cuda')
+  # args.async_checkpoint (default on): write checkpoints on a background
+  # thread; args.save_trainable_only: leave frozen parameters out of them.
+  checkpointer = AsyncCheckpointer(getattr(args, 'async_checkpoint', True))
+  trainable_only = getattr(args, 'save_trainable_only', False)
+  # Parameters a freeze schedule unfreezes later are saved while still frozen,
+  # so that loading model_best.pt also restores their weights of that epoch.
+  keep_params = scheduled_trainable(model, args) if trainable_only else set()
 
   start_epoch, global_step, n_no_improve, best_metric = 0, 0, 0, -np.inf
-
+  start_batch, progress, resume_rng = 0, {}, None
   epoch_train_losses = []
   epoch_val_losses = []
 
-  for i_epoch in range(start_epoch, args.max_epochs):
-      train_losses = []
-      model.train()
-      optimizer.zero_grad()
-
-      for batch in tqdm(args.train_loader, total=len(args.train_loader)):
-          txt, segment, mask, img, tgt = batch
-
-          txt, img = txt.cuda(), img.cuda()
-          mask, segment = mask.cuda(), segment.cuda()
-          tgt = tgt.cuda()
-          out = model(txt, mask, segment, img)
-          loss = criterion(out, tgt)
-
-          train_losses.append(loss.item())
-          loss.backward()
-          global_step += 1
-          if global_step % args.gradient_accumulation_steps == 0:
-              optimizer.step()
-              optimizer.zero_grad()
-
-      model.eval()
-      metrics = model_eval(i_epoch, args.val_loader, model, args)
-      epoch_train_losses.append(np.mean(train_losses))
-      epoch_val_losses.append(metrics['loss'])
-      print('Epoch:', i_epoch)
-      print('Train Loss: {:.4f}'.format(np.mean(train_losses)))
-      print('{}: Loss: {:.5f} | Macro F1 {:.5f} '.format('Val', metrics['loss'], metrics['macro_f1']))
-
-      if len(epoch_train_losses) > 5:
-          plt.figure(figsize=(30, 5))
-          plt.plot(epoch_train_losses)
-          plt.plot(epoch_val_losses)
-          plt.grid()
-          plt.show()
-
-      tuning_metric = metrics['macro_f1']
-      scheduler.step(tuning_metric)
-      is_improvement = tuning_metric > best_metric
-      if is_improvement:
-          best_metric = tuning_metric
-          n_no_improve = 0
-      else:
-          n_no_improve += 1
-
-      save_checkpoint(
-          {'epoch': i_epoch + 1, 'state_dict': model.state_dict(),'optimizer': optimizer.state_dict(),'scheduler': scheduler.state_dict(),'n_no_improve': n_no_improve,'best_metric': best_metric,},
-          is_improvement,
-          savedir,
-      )
-
+  # args.resume: continue from savedir/checkpoint.pt, written after every
+  # epoch and, with args.checkpoint_every_steps, every that many optimizer
+  # steps. A step checkpoint carries the epoch's progress ('train_state'), and
+  # the epoch restarts after its last finished batch.
+  def apply_freeze(epoch):
+      # Unfrozen parameters join the optimizer as a new group at the current lr.
+      changed = freeze_encoders(model, *freeze_levels(args, epoch))
+      in_optimizer = set(id(p) for group in optimizer.param_groups for p in group['params'])
+      new_params = [p for p in model.parameters() if p.requires_grad and id(p) not in in_optimizer]
+      if new_params:
+          optimizer.add_param_group({'params': new_params, 'lr': optimizer.param_groups[0]['lr']})
+          scheduler.min_lrs.append(scheduler.min_lrs[0])
+      return changed
+
+  checkpoint_path = os.path.join(savedir, 'checkpoint.pt')
+  checkpoint = None
+  if getattr(args, 'resume', False) and os.path.exists(checkpoint_path):
+      checkpoint = torch.load(checkpoint_path, map_location=args.device, weights_only=False)
+      # checkpoints from before model_type was saved are taken as they are
+      saved_type = checkpoint.get('model_type')
+      if saved_type is not None and saved_type != model.model_type:
+          print('{} holds a {} checkpoint; not resuming'.format(checkpoint_path, saved_type))
+          checkpoint = None
+  if checkpoint is not None:
+      model.load_state_dict(checkpoint['state_dict'], strict=not checkpoint.get('trainable_only', False))
+      # replay the freeze schedule up to the epochs the saved optimizer has seen:
+      # an epoch checkpoint holds the next epoch, a step checkpoint the current one
+      replayed = checkpoint['epoch'] + (checkpoint.get('train_state', {}).get('step_in_epoch', 0) > 0)
+      for epoch in range(replayed):
+          apply_freeze(epoch)
+      optimizer.load_state_dict(checkpoint['optimizer'])
+      scheduler.load_state_dict(checkpoint['scheduler'])
+      start_epoch, n_no_improve, best_metric = checkpoint['epoch'], checkpoint['n_no_improve'], checkpoint['best_metric']
+      if 'train_state' in checkpoint:
+          progress = checkpoint['train_state']
+          global_step, start_batch = progress['global_step'], progress['step_in_epoch']
+          epoch_train_losses, epoch_val_losses = progress['epoch_train_losses'], progress['epoch_val_losses']
+          scaler.load_state_dict(progress['scaler'])
+          resume_rng = progress['rng']
       if n_no_improve >= args.patience:
-          print('No improvement. Breaking out of loop.')
-          break
-
-def main(args, dataset_path):
-  args.train_loader, args.val_loader, args.test_loader, args = get_dataloader(dataset_path, args)
-  freqs = [args.label_freqs[l] for l in args.labels]
-  label_weights = (torch.FloatTensor(freqs) / args.train_data_len) ** -1
-  args.criterion = nn.BCEWithLogitsLoss(pos_weight=label_weights.cuda())
-
-  bert_model = BertModel.from_pretrained(args.bert_type)
-  if args.resnet_type == 'resnet152':
-    resnet_model = torchvision.models.resnet152(pretrained=True)
-  elif args.resnet_type == 'resnet50':
-    resnet_model = torchvision.models.resnet50(pretrained=True)
-  elif args.resnet_type == 'resnet18':
-    resnet_model = torchvision.models.resnet18(pretrained=True)
-  else:
-    print('Unknown model')
-
-
-  class BertEncoder(nn.Module):
-      def __init__(self, args):
-          super(BertEncoder, self).__init__()
-          self.args = args
-          self.bert = bert_model
-
-      def forward(self, txt, mask, segment):
-          out = self.bert(
-              txt,
-              token_type_ids=segment,
-              attention_mask=mask,
-              output_hidden_states=False,
-          )
-          return out.pooler_output
-
-  class ImageEncoder(nn.Module):
-      def __init__(self, args):
-          super(ImageEncoder, self).__init__()
-          self.args = args
-          model = resnet_model
-          modules = list(model.children())[:-2]
-          self.model = nn.Sequential(*modules)
-
-          pool_func = (
-              nn.AdaptiveAvgPool2d
-              if args.img_embed_pool_type == 'avg'
-              else nn.AdaptiveMaxPool2d
-          )
-
-          if args.num_image_embeds in [1, 2, 3, 5, 7]:
-              self.pool = pool_func((args.num_image_embeds, 1))
-          elif args.num_image_embeds == 4:
-              self.pool = pool_func((2, 2))
-          elif args.num_image_embeds == 6:
-              self.pool = pool_func((3, 2))
-          elif args.num_image_embeds == 8:
-              self.pool = pool_func((4, 2))
-          elif args.num_image_embeds == 9:
-              self.pool = pool_func((3, 3))
-
-      def forward(self, x):
-          out = self.pool(self.model(x))
-          out = torch.flatten(out, start_dim=2)
-          out = out.transpose(1, 2).contiguous()
-          return out
-
-  class MultimodalModel(nn.Module):
-      def __init__(self, args):
-          super(MultimodalModel, self).__init__()
-          self.args = args
-          self.txtenc = BertEncoder(args)
-          self.imgenc = ImageEncoder(args)
-
-          last_size = args.text_hidden_sz + (args.img_hidden_sz * args.num_image_embeds)
-          self.clf = nn.ModuleList()
-
-          self.clf.append(nn.Linear(last_size, args.linear_layer_dim))
-          for i in range(args.linear_layer_count):
-            self.clf.append(nn.Linear(args.linear_layer_dim, args.linear_layer_dim))
-          self.clf.append(nn.Linear(args.linear_layer_dim, args.n_classes))
-
-      def forward(self, txt, mask, segment, img):
-          txt = self.txtenc(txt, mask, segment)
-          img = self.imgenc(img)
-          img = torch.flatten(img, start_dim=1)
-          out = torch.cat([txt, img], -1)
-          for layer in self.clf:
-              out = layer(out)
-          return out
-
-  class TextModel(nn.Module):
-      def __init__(self, args):
-          super(TextModel, self).__init__()
-          self.args = args
-          self.txtenc = BertEncoder(args)
-          self.imgenc = ImageEncoder(args)
-
-          last_size = args.text_hidden_sz
-          self.clf = nn.ModuleList()
-
-          self.clf.append(nn.Linear(last_size, args.linear_layer_dim))
-          for i in range(args.linear_layer_count):
-            self.clf.append(nn.Linear(args.linear_layer_dim, args.linear_layer_dim))
-          self.clf.append(nn.Linear(args.linear_layer_dim, args.n_classes))
-
-      def forward(self, txt, mask, segment, img):
-          txt = self.txtenc(txt, mask, segment)
-          img = self.imgenc(img)
-          img = torch.flatten(img, start_dim=1)
-          out = txt
-          for layer in self.clf:
-              out = layer(out)
-          return out
-
-  class ImgModel(nn.Module):
-      def __init__(self, args):
-          super(ImgModel, self).__init__()
-          self.args = args
-          self.txtenc = BertEncoder(args)
-          self.imgenc = ImageEncoder(args)
-
-          last_size = args.img_hidden_sz * args.num_image_embeds
-          self.clf = nn.ModuleList()
-
-          self.clf.append(nn.Linear(last_size, args.linear_layer_dim))
-          for i in range(args.linear_layer_count):
-            self.clf.append(nn.Linear(args.linear_layer_dim, args.linear_layer_dim))
-          self.clf.append(nn.Linear(args.linear_layer_dim, args.n_classes))
-
-      def forward(self, txt, mask, segment, img):
-          txt = self.txtenc(txt, mask, segment)
-          img = self.imgenc(img)
-          img = torch.flatten(img, start_dim=1)
-          out = img
-          for layer in self.clf:
-              out = layer(out)
-          return out
-
-  class MultimodalModelAvg(nn.Module):
-      def __init__(self, args):
-          super(MultimodalModelAvg, self).__init__()
-          self.args = args
-          self.txtmodel = TextModel(args).cuda()
-          self.imgmodel = ImgModel(args).cuda()
-
-      def forward(self, txt, mask, segment, img):
-          txt_i, mask_i, segment_i, img_i = txt, mask, segment, img
-          txt_t, mask_t, segment_t, img_t = txt, mask, segment, img
-          img = self.imgmodel(txt_i, mask_i, segment_i, img_i)
-          txt = self.txtmodel(txt_t, mask_t, segment_t, img_t)
-          out = (txt+img)/2
-          return out
-
-
-  model_type = []
-  params_count = []
-  test_f1 = []
-
-  
-  print('MultimodelAvg model')
-  model = MultimodalModelAvg(args).cuda()
-
-  model_parameters = filter(lambda p: p.requires_grad, model.parameters())
-  params = sum([np.prod(p.size()) for p in model_parameters])
-  print('Number of parameters: {:.5f} '.format(params))
+          start_epoch = args.max_epochs
+      if is_main_process():
+          print('Resuming at epoch {}, batch {}'.format(start_epoch, start_batch))
+
+  def make_checkpoint(epoch, thresholds, train_state=None):
+      state_dict = trainable_state_dict(model, keep_params) if trainable_only else model.state_dict()
+      state = {'epoch': epoch, 'state_dict': state_dict,'optimizer': optimizer.state_dict(),'scheduler': scheduler.state_dict(),'n_no_improve': n_no_improve,'best_metric': best_metric,'model_type': model.model_type,'thresholds': thresholds,'trainable_only': trainable_only,}
+      if train_state is not None:
+          state['train_state'] = dict(train_state, epoch_train_losses=list(epoch_train_losses), epoch_val_losses=list(epoch_val_losses), scaler=scaler.state_dict(), rng=get_rng_state())
+      return state
+
+  checkpoint_every = getattr(args, 'checkpoint_every_steps', None)
+  # args.telemetry_every: append per-stage timings and throughput every that
+  # many steps to savedir/telemetry.jsonl; args.profile_steps = (start, n):
+  # also write a torch.profiler trace of n steps to savedir/trace.json.
+  telemetry = Telemetry(
+      model, os.path.join(savedir, 'telemetry.jsonl'), getattr(args, 'telemetry_every', None), args.device,
+      getattr(args, 'profile_steps', None), os.path.join(savedir, 'trace.json'),
+      enabled=bool(getattr(args, 'telemetry_every', None)) and is_main_process(),
+  )
+  sampler = resumable_sampler(args.train_loader)
+  thresholds = None
+
+  # Under torch.distributed the forward/backward runs through DDP, which
+  # averages gradients across ranks; checkpoints still hold the bare model.
+  # DDP fixes its set of trainable parameters, so it is rebuilt whenever the
+  # freeze schedule changes them.
+  def wrap_model():
+      if not is_distributed():
+          return model
+      device_ids = [args.device.index] if args.device.type == 'cuda' else None
+      return nn.parallel.DistributedDataParallel(model, device_ids=device_ids)
+  train_model = None
+
+  # A failing run still finishes the checkpoint write in flight.
+  try:
+    for i_epoch in range(start_epoch, args.max_epochs):
+        if sampler is not None:
+            sampler.set_epoch(i_epoch, start_batch)
+        elif start_batch:
+            print('The train loader cannot skip batches; restarting epoch {}'.format(i_epoch))
+            start_batch, progress = 0, {}
+        loss_sum = torch.tensor(progress.get('loss_sum', 0.0), device=args.device)
+        n_steps = progress.get('n_steps', 0)
+        real_tokens, padded_tokens = progress.get('real_tokens', 0), progress.get('padded_tokens', 0)
+        step_in_epoch, start_batch, progress = start_batch, 0, {}
+        if apply_freeze(i_epoch) or train_model is None:
+            train_model = wrap_model()
+        model.train()
+        optimizer.zero_grad()
+        # the first window of the epoch starts here, after the last one's
+        # evaluation and checkpoint
+        telemetry.reset()
+
+        # The loader draws a seed from the torch RNG when it starts an epoch; a
+        # step checkpoint's RNG state was taken after that draw, an epoch one before.
+        if resume_rng is not None and step_in_epoch == 0:
+            set_rng_state(resume_rng)
+            resume_rng = None
+        batches = iter(args.train_loader)
+        if resume_rng is not None:
+            set_rng_state(resume_rng)
+            resume_rng = None
+
+        for batch in tqdm(telemetry.wrap_loader(batches), total=len(args.train_loader), initial=step_in_epoch, disable=not is_main_process()):
+            batch_tokens = 0
+            if batch[2] is not None:
+                batch_tokens = int(batch[2].sum())
+                real_tokens += batch_tokens
+                padded_tokens += batch[2].numel()
+            with telemetry.stage('h2d'):
+                txt, segment, mask, img, tgt = batch_to_device(batch, args.device)
+            # Gradients are only all-reduced on the step that updates weights.
+            sync = not is_distributed() or (global_step + 1) % args.gradient_accumulation_steps == 0
+            with contextlib.nullcontext() if sync else train_model.no_sync():
+                with telemetry.stage('forward'):
+                    with autocast(args):
+                        out = train_model(txt, mask, segment, img)
+                    loss = criterion(out.float(), tgt)
+                with telemetry.stage('backward'):
+                    scaler.scale(loss).backward()
+
+            loss_sum += loss.detach()
+            n_steps += 1
+            step_in_epoch += 1
+            global_step += 1
+            if global_step % args.gradient_accumulation_steps == 0:
+                with telemetry.stage('optimizer_step'):
+                    scaler.step(optimizer)
+                    scaler.update()
+                    optimizer.zero_grad()
+
+                n_updates = global_step // args.gradient_accumulation_steps
+                if checkpoint_every and n_updates % checkpoint_every == 0 and step_in_epoch < len(args.train_loader) and is_main_process():
+                    train_state = {'global_step': global_step, 'step_in_epoch': step_in_epoch, 'loss_sum': loss_sum.item(), 'n_steps': n_steps, 'real_tokens': real_tokens, 'padded_tokens': padded_tokens}
+                    checkpointer.save(make_checkpoint(i_epoch, thresholds, train_state), False, savedir)
+            telemetry.step(i_epoch, global_step, len(tgt), batch_tokens)
+
+        telemetry.flush(i_epoch, global_step)
+        model.eval()
+        metrics = model_eval(i_epoch, args.val_loader, model, args)
+        if is_distributed():
+            loss_sum /= dist.get_world_size()
+            dist.all_reduce(loss_sum)
+        train_loss = (loss_sum / max(n_steps, 1)).item()
+        epoch_train_losses.append(train_loss)
+        epoch_val_losses.append(metrics['loss'])
+        if is_main_process():
+            print('Epoch:', i_epoch)
+            print('Train Loss: {:.4f}'.format(train_loss))
+            if padded_tokens:
+                print('Padding waste: {:.2%}'.format(1 - real_tokens / padded_tokens))
+            print('{}: Loss: {:.5f} | Macro F1 {:.5f} '.format('Val', metrics['loss'], metrics['macro_f1']))
+
+        if len(epoch_train_losses) > 5 and is_main_process():
+            import matplotlib.pyplot as plt
+            plt.figure(figsize=(30, 5))
+            plt.plot(epoch_train_losses)
+            plt.plot(epoch_val_losses)
+            plt.grid()
+            plt.show()
+
+        thresholds = metrics['thresholds']
+        tuning_metric = metrics['macro_f1']
+        scheduler.step(tuning_metric)
+        is_improvement = tuning_metric > best_metric
+        if is_improvement:
+            best_metric = tuning_metric
+            n_no_improve = 0
+        else:
+            n_no_improve += 1
+
+        # Metrics are gathered over all ranks, so every rank takes the same
+        # scheduler and early-stopping decisions; only rank 0 writes files.
+        if is_main_process():
+            train_state = {'global_step': global_step, 'step_in_epoch': 0}
+            checkpointer.save(make_checkpoint(i_epoch + 1, thresholds, train_state), is_improvement, savedir, labels=args.labels)
+
+        if n_no_improve >= args.patience:
+            if is_main_process():
+                print('No improvement. Breaking out of loop.')
+            break
+  finally:
+      checkpointer.close()
+      telemetry.close()
+  if is_distributed():
+      dist.barrier()
+
+class FreezableEncoder(nn.Module):
+    # An encoder as an ordered list of stages, input side first. freeze(n)
+    # freezes the input stage and the n lowest layers after it (-1: every
+    # stage). Frozen stages stay in eval mode, so BatchNorm statistics and
+    # dropout do not change them either.
+    def stages(self):
+        raise NotImplementedError
+
+    def n_frozen(self, n_layers):
+        if n_layers == -1:
+            return len(self.stages())
+        return min(n_layers + 1, len(self.stages())) if n_layers else 0
+
+    def freeze(self, n_layers):
+        stages = self.stages()
+        n_frozen = self.n_frozen(n_layers)
+        for i, stage in enumerate(stages):
+            for p in stage.parameters():
+                p.requires_grad = i >= n_frozen
+        self.frozen = stages[:n_frozen]
+        return self.train(self.training)
+
+    def train(self, mode=True):
+        super(FreezableEncoder, self).train(mode)
+        for stage in getattr(self, 'frozen', []):
+            stage.eval()
+        return self
+
+class BertEncoder(FreezableEncoder):
+    def __init__(self, args, bert_model):
+        super(BertEncoder, self).__init__()
+        self.bert = bert_model
+        # args.activation_checkpointing: recompute the transformer layers'
+        # activations in backward instead of keeping them
+        if getattr(args, 'activation_checkpointing', False):
+            self.bert.gradient_checkpointing_enable(gradient_checkpointing_kwargs={'use_reentrant': False})
+
+    def stages(self):
+        return [self.bert.embeddings] + list(self.bert.encoder.layer) + [self.bert.pooler]
+
+    def forward(self, txt, mask, segment):
+        out = self.bert(
+            txt,
+            token_type_ids=segment,
+            attention_mask=mask,
+            output_hidden_states=False,
+        )
+        return out.pooler_output
+
+@contextlib.contextmanager
+def kept_bn_stats(module):
+    # The recompute of a checkpointed stage runs its BatchNorm layers in train
+    # mode a second time; restore their running stats so one step counts once.
+    buffers = [b for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)
+               for b in m.buffers(recurse=False)]
+    saved = [b.clone() for b in buffers]
+    try:
+        yield
+    finally:
+        with torch.no_grad():
+            for b, s in zip(buffers, saved):
+                b.copy_(s)
+
+class ImageEncoder(FreezableEncoder):
+    def __init__(self, args, resnet_model):
+        super(ImageEncoder, self).__init__()
+        model = resnet_model
+        modules = list(model.children())[:-2]
+        self.model = nn.Sequential(*modules)
+        self.checkpointing = getattr(args, 'activation_checkpointing', False)
+
+        pool_func = (
+            nn.AdaptiveAvgPool2d
+            if args.img_embed_pool_type == 'avg'
+            else nn.AdaptiveMaxPool2d
+        )
 
-  args.optimizer = optim.AdamW(model.parameters(), lr=args.lr)
-  args.scheduler = optim.lr_scheduler.ReduceLROnPlateau(args.optimizer, 'max', patience=args.lr_patience, verbose=True, factor=args.lr_factor)
-  torch.save(args, os.path.join(args.savedir_multimodal, 'args.pt'))
-  model_train(model, args, args.savedir_multimodal)
-  load_checkpoint(model, os.path.join(args.savedir_multimodal, 'model_best.pt'))
-  model.eval()
-  test_metrics = model_eval(np.inf, args.test_loader, model, args)
-  print('{}: Loss: {:.5f} | Macro F1 {:.5f}'.format('Test', test_metrics['loss'], test_metrics['macro_f1']))
-  model_type.append('multimodel_avg')
-  params_count.append(params)
-  test_f1.append(test_metrics['macro_f1'])
-  
+        if args.num_image_embeds in [1, 2, 3, 5, 7]:
+            self.pool = pool_func((args.num_image_embeds, 1))
+        elif args.num_image_embeds == 4:
+            self.pool = pool_func((2, 2))
+        elif args.num_image_embeds == 6:
+            self.pool = pool_func((3, 2))
+        elif args.num_image_embeds == 8:
+            self.pool = pool_func((4, 2))
+        elif args.num_image_embeds == 9:
+            self.pool = pool_func((3, 3))
+
+    def stages(self):
+        # the stem (conv1, bn1, relu, maxpool), then layer1 to layer4
+        return [self.model[:4]] + list(self.model[4:])
+
+    def forward(self, x):
+        if self.checkpointing and self.training:
+            # Recompute each trainable stage's activations in backward.
+            for stage in self.stages():
+                if any(p.requires_grad for p in stage.parameters()):
+                    x = torch.utils.checkpoint.checkpoint(
+                        stage, x, use_reentrant=False,
+                        context_fn=lambda stage=stage: (contextlib.nullcontext(), kept_bn_stats(stage)))
+                else:
+                    x = stage(x)
+        else:
+            x = self.model(x)
+        out = self.pool(x)
+        out = torch.flatten(out, start_dim=2)
+        out = out.transpose(1, 2).contiguous()
+        return out
+
+def build_clf(last_size, args):
+    clf = nn.ModuleList()
+    clf.append(nn.Linear(last_size, args.linear_layer_dim))
+    for i in range(args.linear_layer_count):
+      clf.append(nn.Linear(args.linear_layer_dim, args.linear_layer_dim))
+    clf.append(nn.Linear(args.linear_layer_dim, args.n_classes))
+    return clf
+
+# Every model declares the inputs it consumes in `modalities`, so that the
+# datasets can skip tokenizing or decoding whatever the model would ignore.
+class MultimodalModel(nn.Module):
+    model_type = 'multimodel'
+    modalities = ('text', 'img')
+
+    def __init__(self, args, bert_model, resnet_model):
+        super(MultimodalModel, self).__init__()
+        self.txtenc = BertEncoder(args, bert_model)
+        self.imgenc = ImageEncoder(args, resnet_model)
+
+        last_size = args.text_hidden_sz + (args.img_hidden_sz * args.num_image_embeds)
+        self.clf = build_clf(last_size, args)
+
+    def forward(self, txt, mask, segment, img):
+        txt = self.txtenc(txt, mask, segment)
+        img = self.imgenc(img)
+        img = torch.flatten(img, start_dim=1)
+        out = torch.cat([txt, img], -1)
+        for layer in self.clf:
+            out = layer(out)
+        return out
+
+class TextModel(nn.Module):
+    model_type = 'text'
+    modalities = ('text',)
+
+    def __init__(self, args, bert_model):
+        super(TextModel, self).__init__()
+        self.txtenc = BertEncoder(args, bert_model)
+
+        last_size = args.text_hidden_sz
+        self.clf = build_clf(last_size, args)
+
+    def forward(self, txt, mask, segment, img=None):
+        out = self.txtenc(txt, mask, segment)
+        for layer in self.clf:
+            out = layer(out)
+        return out
+
+class ImgModel(nn.Module):
+    model_type = 'image'
+    modalities = ('img',)
+
+    def __init__(self, args, resnet_model):
+        super(ImgModel, self).__init__()
+        self.imgenc = ImageEncoder(args, resnet_model)
+
+        last_size = args.img_hidden_sz * args.num_image_embeds
+        self.clf = build_clf(last_size, args)
+
+    def forward(self, txt, mask, segment, img):
+        img = self.imgenc(img)
+        out = torch.flatten(img, start_dim=1)
+        for layer in self.clf:
+            out = layer(out)
+        return out
+
+# Late fusion: a single BertEncoder and a single ImageEncoder run once per batch
+# and their pooled outputs feed two independent classifier heads whose logits
+# are averaged. Both heads see the same encoder weights; nothing else is shared.
+class MultimodalModelAvg(nn.Module):
+    model_type = 'multimodel_avg'
+    modalities = ('text', 'img')
+
+    def __init__(self, args, bert_model, resnet_model):
+        super(MultimodalModelAvg, self).__init__()
+        self.txtenc = BertEncoder(args, bert_model)
+        self.imgenc = ImageEncoder(args, resnet_model)
+
+        self.txtclf = build_clf(args.text_hidden_sz, args)
+        self.imgclf = build_clf(args.img_hidden_sz * args.num_image_embeds, args)
+
+    def forward(self, txt, mask, segment, img):
+        txt = self.txtenc(txt, mask, segment)
+        img = self.imgenc(img)
+        img = torch.flatten(img, start_dim=1)
+        for layer in self.txtclf:
+            txt = layer(txt)
+        for layer in self.imgclf:
+            img = layer(img)
+        out = (txt+img)/2
+        return out
+
+def build_model(model_type, args, bert_model, resnet_model):
+  if model_type == 'multimodel_avg':
+    return MultimodalModelAvg(args, bert_model, resnet_model)
+  if model_type == 'multimodel':
+    return MultimodalModel(args, bert_model, resnet_model)
+  if model_type == 'text':
+    return TextModel(args, bert_model)
+  if model_type == 'image':
+    return ImgModel(args, resnet_model)
+  raise ValueError('Unknown model type: {}'.format(model_type))
+
+def set_modalities(args, modalities):
+  for loader in (args.train_loader, args.val_loader, args.test_loader):
+    loader.dataset.modalities = modalities
+
+class PrecomputedEncoder(nn.Module):
+    def forward(self, x, *args):
+        return x
+
+def use_precomputed_features(model):
+  # Swap the encoders for a pass-through so the model consumes cached features.
+  for name in ('txtenc', 'imgenc'):
+    if hasattr(model, name):
+      setattr(model, name, PrecomputedEncoder())
+  return model
+
+class FeatureDataset(Dataset):
+    def __init__(self, txt_path, img_path, base, modalities=('text', 'img')):
+        self.txt_path = txt_path
+        self.img_path = img_path
+        self.base = base
+        self.modalities = modalities
+        self.txt_features = None
+        self.img_features = None
 
-  print('Multimodel model')
-  model = MultimodalModel(args).cuda()
+    def __len__(self):
+        return len(self.base)
 
+    def __getitem__(self, index):
+        if self.txt_features is None:
+            self.txt_features = np.load(self.txt_path, mmap_mode='r')
+            self.img_features = np.load(self.img_path, mmap_mode='r')
+
+        txt, img = None, None
+        if 'text' in self.modalities:
+            txt = torch.from_numpy(np.array(self.txt_features[index]))
+        if 'img' in self.modalities:
+            img = torch.from_numpy(np.array(self.img_features[index]))
+        return txt, None, img, self.base.load_label(index)
+
+def feature_collate_fn(batch):
+    txt, img = None, None
+    if batch[0][0] is not None:
+        txt = torch.stack([row[0] for row in batch])
+    if batch[0][2] is not None:
+        img = torch.stack([row[2] for row in batch])
+    tgt = torch.stack([row[3] for row in batch])
+    return txt, None, None, img, tgt
+
+def feature_cache_key(args, data_file):
+  # the features are computed under autocast(args), so its dtype is part of the key
+  precision = 'float32'
+  if getattr(args, 'amp', False):
+    precision = 'float16' if args.device.type == 'cuda' else 'bfloat16'
+  config = json.dumps([
+      args.bert_type, args.resnet_type, args.img_embed_pool_type,
+      args.num_image_embeds, args.max_seq_len, file_sha1(data_file), precision,
+  ])
+  return hashlib.sha1(config.encode()).hexdigest()[:16]
+
+def build_feature_cache(dataset, txtenc, imgenc, txt_path, img_path, args):
+  loader = DataLoader(dataset,batch_size=args.batch_sz,shuffle=False,num_workers=args.n_workers,collate_fn=functools.partial(collate_fn, args=args),)
+  dataset.modalities = ('text', 'img')
+  txt_out, img_out = None, None
+  txtenc.eval()
+  imgenc.eval()
+  pos = 0
+  with torch.no_grad():
+    for batch in tqdm(loader, total=len(loader)):
+      txt, segment, mask, img, tgt = batch_to_device(batch, args.device)
+      with autocast(args):
+        txt = txtenc(txt, mask, segment)
+        img = imgenc(img)
+      txt = txt.float().cpu().numpy()
+      img = img.float().cpu().numpy()
+      if txt_out is None:
+        txt_out = np.lib.format.open_memmap(txt_path + '.tmp', mode='w+', dtype=np.float32, shape=(len(dataset),) + txt.shape[1:])
+        img_out = np.lib.format.open_memmap(img_path + '.tmp', mode='w+', dtype=np.float32, shape=(len(dataset),) + img.shape[1:])
+      txt_out[pos:pos + len(txt)] = txt
+      img_out[pos:pos + len(img)] = img
+      pos += len(txt)
+  txt_out.flush()
+  img_out.flush()
+  del txt_out, img_out
+  os.replace(txt_path + '.tmp', txt_path)
+  os.replace(img_path + '.tmp', img_path)
+
+def get_feature_loaders(dataset_path, bert_model, resnet_model, args):
+  # Run the frozen pretrained encoders once per split and serve their pooled
+  # outputs from memory-mapped .npy files keyed by encoder config and data hash.
+  os.makedirs(args.feature_cache_dir, exist_ok=True)
+  txtenc = BertEncoder(args, bert_model).to(args.device)
+  imgenc = ImageEncoder(args, resnet_model).to(args.device)
+
+  loaders = []
+  for split, loader in (('train', args.train_loader), ('val', args.val_loader), ('test', args.test_loader)):
+    key = feature_cache_key(args, os.path.join(dataset_path, split + '.jsonl'))
+    txt_path = os.path.join(args.feature_cache_dir, '{}-{}.txt.npy'.format(split, key))
+    img_path = os.path.join(args.feature_cache_dir, '{}-{}.img.npy'.format(split, key))
+    with main_process_first():
+      if not (os.path.exists(txt_path) and os.path.exists(img_path)):
+        print('Encoding {} split into {}'.format(split, args.feature_cache_dir))
+        build_feature_cache(loader.dataset, txtenc, imgenc, txt_path, img_path, args)
+
+    dataset = FeatureDataset(txt_path, img_path, loader.dataset)
+    if split == 'train':
+      loaders.append(DataLoader(dataset,batch_size=args.batch_sz,sampler=train_sampler(dataset, args),collate_fn=feature_collate_fn,drop_last=True,))
+    else:
+      loaders.append(DataLoader(dataset,batch_size=args.batch_sz,shuffle=False,sampler=distributed_sampler(dataset, False),collate_fn=feature_collate_fn,))
+
+  return loaders
+
+RESNET_TYPES = ('resnet152', 'resnet50', 'resnet18')
+
+def weights_cache_dir(args):
+  # args.weights_cache_dir (or $WEIGHTS_CACHE_DIR): the pretrained encoders are
+  # saved there as safetensors the first time they are needed and loaded from
+  # there afterwards, so a filled cache needs no network.
+  return getattr(args, 'weights_cache_dir', None) or os.environ.get('WEIGHTS_CACHE_DIR')
+
+def fill_cache_dir(path, fill):
+  # fill(tmp) writes the entry into a private directory, renamed into place
+  # once complete; of several processes (or ranks) filling it at once the
+  # first rename wins.
+  if os.path.exists(path):
+    return path
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  tmp = '{}.tmp{}'.format(path, os.getpid())
+  try:
+    fill(tmp)
+  except BaseException:
+    shutil.rmtree(tmp, ignore_errors=True)
+    raise
+  try:
+    os.rename(tmp, path)
+  except OSError:
+    shutil.rmtree(tmp)
+  return path
+
+def bert_path(bert_type, cache_dir=None):
+  # Where from_pretrained loads bert_type (weights, config and tokenizer) from.
+  # A local directory is used as it is.
+  if cache_dir is None or os.path.isdir(bert_type):
+    return bert_type
+
+  def fill(tmp):
+    from transformers import BertModel, BertTokenizerFast
+    BertModel.from_pretrained(bert_type).save_pretrained(tmp, safe_serialization=True)
+    BertTokenizerFast.from_pretrained(bert_type, do_lower_case=True).save_pretrained(tmp)
+  return fill_cache_dir(os.path.join(cache_dir, 'bert', bert_type.replace('/', '--')), fill)
+
+def load_bert(bert_type, cache_dir=None):
+  from transformers import BertModel
+  return BertModel.from_pretrained(bert_path(bert_type, cache_dir))
+
+def empty_resnet(resnet_type):
+  # The architecture on the meta device, to load a state dict into with
+  # assign=True (or to_empty first); skips the random init, which takes about
+  # a second for resnet152.
+  import torchvision
+  if resnet_type not in RESNET_TYPES:
+    raise ValueError('Unknown model: {}'.format(resnet_type))
+  with torch.device('meta'):
+    return getattr(torchvision.models, resnet_type)()
+
+def resnet_path(resnet_type, cache_dir):
+  def fill(tmp):
+    import safetensors.torch
+    os.makedirs(tmp)
+    safetensors.torch.save_file(load_resnet(resnet_type).state_dict(), os.path.join(tmp, 'model.safetensors'))
+  return os.path.join(fill_cache_dir(os.path.join(cache_dir, 'resnet', resnet_type), fill), 'model.safetensors')
+
+def load_resnet(resnet_type, cache_dir=None):
+  if resnet_type not in RESNET_TYPES:
+    raise ValueError('Unknown model: {}'.format(resnet_type))
+  if cache_dir is None:
+    import torchvision
+    return getattr(torchvision.models, resnet_type)(pretrained=True)
+  import safetensors.torch
+  model = empty_resnet(resnet_type)
+  model.load_state_dict(safetensors.torch.load_file(resnet_path(resnet_type, cache_dir)), assign=True)
+  return model
+
+def fresh_encoders(model_type, bert_model, resnet_model):
+  # Copies of the pretrained encoders the model needs, so fine-tuning one
+  # model never changes the weights the next one starts from.
+  bert_copy = copy.deepcopy(bert_model) if model_type != 'image' else None
+  resnet_copy = copy.deepcopy(resnet_model) if model_type != 'text' else None
+  return bert_copy, resnet_copy
+
+def freeze_levels(args, epoch):
+  # args.freeze_bert_layers / args.freeze_resnet_layers: how many lower layers
+  # (plus the embeddings / stem) to freeze, -1 for the whole encoder.
+  # args.freeze_schedule = {epoch: (bert_layers, resnet_layers), ...} replaces
+  # them from each listed epoch on, e.g. {0: (-1, -1), 2: (6, 2), 4: (0, 0)}.
+  levels = (getattr(args, 'freeze_bert_layers', 0), getattr(args, 'freeze_resnet_layers', 0))
+  schedule = getattr(args, 'freeze_schedule', None) or {}
+  for start in sorted(schedule, key=int):
+    if int(start) <= epoch:
+      levels = tuple(schedule[start])
+  return levels
+
+def scheduled_trainable(model, args):
+  # Names of the parameters trainable now or at any epoch of the freeze
+  # schedule.
+  trainable = set(id(p) for p in model.parameters() if p.requires_grad)
+  for epoch in range(args.max_epochs):
+    levels = dict(zip((BertEncoder, ImageEncoder), freeze_levels(args, epoch)))
+    for module in model.modules():
+      if isinstance(module, FreezableEncoder):
+        for stage in module.stages()[module.n_frozen(levels[type(module)]):]:
+          trainable.update(id(p) for p in stage.parameters())
+  return set(n for n, p in model.named_parameters() if id(p) in trainable)
+
+def freeze_encoders(model, bert_layers, resnet_layers):
+  # Returns whether the set of trainable parameters changed.
+  before = [p.requires_grad for p in model.parameters()]
+  for module in model.modules():
+    if isinstance(module, BertEncoder):
+      module.freeze(bert_layers)
+    elif isinstance(module, ImageEncoder):
+      module.freeze(resnet_layers)
+  return before != [p.requires_grad for p in model.parameters()]
+
+def train_and_evaluate(model, args, savedir):
   model_parameters = filter(lambda p: p.requires_grad, model.parameters())
   params = sum([np.prod(p.size()) for p in model_parameters])
-  print('Number of parameters: {:.5f} '.format(params))
-
-  args.optimizer = optim.AdamW(model.parameters(), lr=args.lr)
+  if is_main_process():
+    print('Number of parameters: {:.5f} '.format(params))
+  if freeze_encoders(model, *freeze_levels(args, 0)) and is_main_process():
+    print('Trainable at the start: {}'.format(sum(p.numel() for p in model.parameters() if p.requires_grad)))
+
+  # Frozen parameters get no AdamW state; model_train adds them when a
+  # freeze schedule unfreezes them.
+  args.optimizer = optim.AdamW([p for p in model.parameters() if p.requires_grad], lr=args.lr)
   args.scheduler = optim.lr_scheduler.ReduceLROnPlateau(args.optimizer, 'max', patience=args.lr_patience, verbose=True, factor=args.lr_factor)
-  torch.save(args, os.path.join(args.savedir_multimodal, 'args.pt'))
-  model_train(model, args, args.savedir_multimodal)
-  load_checkpoint(model, os.path.join(args.savedir_multimodal, 'model_best.pt'))
+  if is_main_process():
+    save_args(args, os.path.join(savedir, 'args.pt'))
+  model_train(model, args, savedir)
+  load_checkpoint(model, os.path.join(savedir, 'model_best.pt'), args.device)
   model.eval()
   test_metrics = model_eval(np.inf, args.test_loader, model, args)
-  print('{}: Loss: {:.5f} | Macro F1 {:.5f}'.format('Test', test_metrics['loss'], test_metrics['macro_f1']))
-  model_type.append('multimodel')
-  params_count.append(params)
-  test_f1.append(test_metrics['macro_f1'])
+  if is_main_process():
+    print('{}: Loss: {:.5f} | Macro F1 {:.5f}'.format('Test', test_metrics['loss'], test_metrics['macro_f1']))
+  return params, test_metrics
 
+MODEL_NAMES = {
+    'multimodel_avg': 'MultimodelAvg model',
+    'multimodel': 'Multimodel model',
+    'text': 'Text model',
+    'image': 'Image model',
+}
 
-  print('Text model')
-  model = TextModel(args).cuda()
-
-  model_parameters = filter(lambda p: p.requires_grad, model.parameters())
-  params = sum([np.prod(p.size()) for p in model_parameters])
-  print('Number of parameters: {:.5f} '.format(params))
-
-  optimizer = optim.AdamW(model.parameters(), lr=args.lr)
-  scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, 'max', patience=args.lr_patience, verbose=True, factor=args.lr_factor)
-  torch.save(args, os.path.join(args.savedir_text, 'args.pt'))
-  model_train(model, args, args.savedir_text)
-  load_checkpoint(model, os.path.join(args.savedir_text, 'model_best.pt'))
-  model.eval()
-  test_metrics = model_eval(np.inf, args.test_loader, model, args)
-  print('{}: Loss: {:.5f} | Macro F1 {:.5f}'.format('Test', test_metrics['loss'], test_metrics['macro_f1']))
-  model_type.append('text')
-  params_count.append(params)
-  test_f1.append(test_metrics['macro_f1'])
-
-
-
-  print('Image model')
-  model = ImgModel(args).cuda()
+def main(args, dataset_path):
+  get_device(args)
+  if getattr(args, 'distributed', False):
+    init_distributed(args)
+  args.train_loader, args.val_loader, args.test_loader, args = get_dataloader(dataset_path, args)
+  args.criterion = make_criterion(args)
+
+  # Pretrained weights; every model below is built on its own copy of them.
+  bert_model = load_bert(args.bert_type, weights_cache_dir(args))
+  resnet_model = load_resnet(args.resnet_type, weights_cache_dir(args))
+
+  # With a feature cache the encoders stay frozen at their pretrained weights
+  # and only the clf heads are trained on the cached pooled outputs.
+  use_feature_cache = getattr(args, 'feature_cache_dir', None) is not None
+  if use_feature_cache:
+    args.train_loader, args.val_loader, args.test_loader = get_feature_loaders(dataset_path, *fresh_encoders('multimodel', bert_model, resnet_model), args)
+
+  # multimodel_avg gets its own directory: with resume each model has to find
+  # its own checkpoint.pt.
+  savedirs = {
+      'multimodel_avg': os.path.join(args.savedir_multimodal, 'avg'),
+      'multimodel': args.savedir_multimodal,
+      'text': args.savedir_text,
+      'image': args.savedir_image,
+  }
 
-  model_parameters = filter(lambda p: p.requires_grad, model.parameters())
-  params = sum([np.prod(p.size()) for p in model_parameters])
-  print('Number of parameters: {:.5f} '.format(params))
+  model_type = []
+  params_count = []
+  test_f1 = []
 
-  optimizer = optim.AdamW(model.parameters(), lr=args.lr)
-  scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, 'max', patience=args.lr_patience, verbose=True, factor=args.lr_factor)
-  torch.save(args, os.path.join(args.savedir_image, 'args.pt'))
-  model_train(model, args, args.savedir_image)
-  load_checkpoint(model, os.path.join(args.savedir_image, 'model_best.pt'))
-  model.eval()
-  test_metrics = model_eval(np.inf, args.test_loader, model, args)
-  print('{}: Loss: {:.5f} | Macro F1 {:.5f}'.format('Test', test_metrics['loss'], test_metrics['macro_f1']))
-  model_type.append('image')
-  params_count.append(params)
-  test_f1.append(test_metrics['macro_f1'])
+  for name in ('multimodel_avg', 'multimodel', 'text', 'image'):
+    if is_main_process():
+      print(MODEL_NAMES[name])
+    if use_feature_cache:
+      # head-only: the encoders are swapped out before anything is copied or
+      # moved to the device
+      model = use_precomputed_features(build_model(name, args, bert_model, resnet_model))
+    else:
+      model = build_model(name, args, *fresh_encoders(name, bert_model, resnet_model))
+    model = model.to(args.device)
+    set_modalities(args, model.modalities)
+
+    os.makedirs(savedirs[name], exist_ok=True)
+    params, test_metrics = train_and_evaluate(model, args, savedirs[name])
+    model_type.append(name)
+    params_count.append(params)
+    test_f1.append(test_metrics['macro_f1'])
 
   return model_type, params_count, test_f1